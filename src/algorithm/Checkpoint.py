@@ -0,0 +1,40 @@
+# algorithm/Checkpoint.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+
+# Full copy of the algorithm state at a given step. The tree is recorded as the (node, left, right, degree) links of
+# every node in it, so the very same node objects can be relinked on restore. Checkpoints are only restored going
+# back, and the log only ever grows along a derivation, so just its length is kept.
+class Checkpoint():
+    step = None
+    state = None
+    external_merge_round = None
+    last_choice = None
+    choice_steps = None
+
+    root = None
+    structure = None
+    highlighted_nodes = None
+    lexicalizations = None
+    pending_moves = None
+
+    log_length = None
+
+    def __init__(self, step, state, external_merge_round, last_choice, choice_steps, root, structure,
+                 highlighted_nodes, lexicalizations, pending_moves, log_length):
+        self.step = step
+        self.state = state
+        self.external_merge_round = external_merge_round
+        self.last_choice = last_choice
+        self.choice_steps = choice_steps
+        self.root = root
+        self.structure = structure
+        self.highlighted_nodes = highlighted_nodes
+        self.lexicalizations = lexicalizations
+        self.pending_moves = pending_moves
+        self.log_length = log_length
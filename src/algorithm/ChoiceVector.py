@@ -0,0 +1,80 @@
+# algorithm/ChoiceVector.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+import binascii
+
+
+# Identifies a derivation of a given setup by the alternative taken at each of its choice points, in order. The
+# compact form stores every index as an unsigned LEB128 varint, so most derivations take one byte per choice.
+class ChoiceVector():
+    choices = None
+
+    def __init__(self, choices=()):
+        self.choices = tuple(choices)
+
+    def __len__(self):
+        return len(self.choices)
+
+    def __iter__(self):
+        return iter(self.choices)
+
+    def __eq__(self, other):
+        return isinstance(other, ChoiceVector) and self.choices == other.choices
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.choices)
+
+    def to_bytes(self):
+        data = bytearray()
+
+        for choice in self.choices:
+            if choice < 0:
+                raise RuntimeError("Invalid choice index: {0}".format(choice))
+
+            while choice >= 0x80:
+                data.append((choice & 0x7f) | 0x80)
+                choice >>= 7
+            data.append(choice)
+
+        return bytes(data)
+
+    def to_hex(self):
+        return binascii.hexlify(self.to_bytes())
+
+    @staticmethod
+    def from_bytes(data):
+        choices = []
+        value = 0
+        shift = 0
+
+        for byte in bytearray(data):
+            value |= (byte & 0x7f) << shift
+
+            if byte & 0x80:
+                shift += 7
+            else:
+                choices.append(value)
+                value = 0
+                shift = 0
+
+        if shift != 0:
+            raise RuntimeError("Truncated choice vector")
+
+        return ChoiceVector(choices)
+
+    @staticmethod
+    def from_hex(text):
+        try:
+            data = binascii.unhexlify(text)
+        except (TypeError, ValueError):
+            raise RuntimeError("Invalid choice vector: '{0}'".format(text))
+
+        return ChoiceVector.from_bytes(data)
@@ -0,0 +1,25 @@
+# algorithm/Derivation.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+from algorithm.ChoiceVector import ChoiceVector
+
+
+class Derivation():
+    choices = None
+    success = None
+    spellout = None
+    score = None
+
+    def __init__(self, choices, success, spellout, score=None):
+        self.choices = tuple(choices)
+        self.success = success
+        self.spellout = spellout
+        self.score = score
+
+    def choice_vector(self):
+        return ChoiceVector(self.choices)
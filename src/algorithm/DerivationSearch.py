@@ -0,0 +1,231 @@
+# algorithm/DerivationSearch.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+import heapq
+import itertools
+import multiprocessing
+
+from algorithm.Setup import Setup
+from algorithm.SpelloutAlgorithm import SpelloutAlgorithm
+from algorithm.Derivation import Derivation
+from algorithm.TranspositionTable import TranspositionTable
+
+
+# Enumerates every complete derivation for a setup, depth-first, in the same order as repeatedly asking the app for
+# the next possibility. The algorithm state is forked at each choice point instead of being undone and replayed.
+#
+# Choice points whose state was already explored through a different path are looked up in a transposition table,
+# and the derivations found below them the first time are reused instead of being searched again.
+class DerivationSearch():
+    max_table_entry_size = 4096
+
+    _setup = None
+    _table_size = None
+    _table = None
+
+    def __init__(self, setup, transposition_table_size=4096):
+        self._setup = setup
+        self._table_size = transposition_table_size
+        self._table = TranspositionTable(transposition_table_size) if transposition_table_size else None
+
+    def derivations(self):
+        for _, derivation in self._explore(self._start(), [], None):
+            yield derivation
+
+    # Yields the derivations that come after the given choice vector (complete or not) in the order of derivations(),
+    # i.e. those that depart from it by taking a later alternative at one of its choices. The derivations before it
+    # are not searched.
+    def derivations_after(self, choices):
+        algorithm = self._start()
+        choice_states = []
+
+        for choice in choices:
+            self._run_to_choice(algorithm)
+            if not algorithm.in_choice_state():
+                raise RuntimeError("Choice vector is longer than the derivation")
+
+            choice_states.append(algorithm.fork())
+            algorithm.go_forward(choice)
+
+        for index in xrange(len(choices) - 1, -1, -1):
+            state = choice_states[index]
+
+            for alternative in xrange(choices[index] + 1, len(state.alternatives())):
+                branch = state.fork()
+                branch.go_forward(alternative)
+
+                for _, derivation in self._explore(branch, list(choices[:index]) + [alternative], None):
+                    yield derivation
+
+    # Splits the search at the first split_depth choice points and explores the resulting subtrees in a process
+    # pool. Results are merged back in the same order derivations() would produce them.
+    def parallel_derivations(self, processes=None, split_depth=3):
+        root = self._start()
+
+        frontier = list(self._explore(root, [], split_depth))
+
+        setup_obj = self._setup.to_json_obj()
+        tasks = [(setup_obj, self._table_size, choices) for choices, derivation in frontier if derivation is None]
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap(_search_subtree, tasks)
+
+            for _, derivation in frontier:
+                if derivation is not None:
+                    yield derivation
+                    continue
+
+                for choices, success, spellout_ids in next(results):
+                    spellout = [root.lexicon_entry_by_id(entry_id) for entry_id in spellout_ids]
+                    yield Derivation(choices, success, spellout)
+        finally:
+            pool.terminate()
+
+    # Yields the k best successful derivations (all of them if k is None), best first. A derivation's score is the
+    # pair (total extras, number of movements) over all its lexicalizations; ties are broken by choice vector, so
+    # equally good derivations come out in the order derivations() would produce them. Since scores never decrease
+    # along a derivation, a best-first search over partial derivations can stop as soon as k have been found.
+    def best_derivations(self, k=None):
+        counter = itertools.count()
+        heap = [((0, 0), (), next(counter), self._start())]
+        found = 0
+
+        while len(heap) > 0 and (k is None or found < k):
+            score, choices, _, algorithm = heapq.heappop(heap)
+
+            while algorithm.can_go_forward() and not algorithm.matches():
+                algorithm.go_forward()
+
+            if not algorithm.can_go_forward():
+                if algorithm.success():
+                    found += 1
+                    yield Derivation(choices, True, algorithm.spellout(), score)
+                continue
+
+            matches = algorithm.matches()
+            for index, match in enumerate(matches):
+                branch = algorithm.fork() if index < len(matches) - 1 else algorithm
+                branch.go_forward(index)
+
+                branch_score = (score[0] + match.extras, score[1] + (1 if match.moved is not None else 0))
+                branch_choices = choices + (index,) if len(matches) > 1 else choices
+
+                heapq.heappush(heap, (branch_score, branch_choices, next(counter), branch))
+
+    def replay(self, choices):
+        algorithm = self._start()
+
+        for choice in choices:
+            self._run_to_choice(algorithm)
+            if not algorithm.in_choice_state():
+                raise RuntimeError("Choice vector is longer than the derivation")
+
+            algorithm.go_forward(choice)
+
+        return algorithm
+
+    # Replays a complete choice vector and returns the final (quiet) algorithm state
+    def replay_to_end(self, choices):
+        algorithm = self.replay(choices)
+
+        self._run_to_choice(algorithm)
+        if algorithm.in_choice_state():
+            raise RuntimeError("Choice vector is shorter than the derivation")
+
+        return algorithm
+
+    def derivation(self, choices):
+        algorithm = self.replay_to_end(choices)
+
+        return Derivation(choices, algorithm.success(), algorithm.spellout())
+
+    def _start(self):
+        algorithm = SpelloutAlgorithm()
+        algorithm.set_quiet(True)
+        algorithm.start(self._setup)
+
+        return algorithm
+
+    # Yields (choices, derivation) for every finished derivation below the given state, and (choices, None) for every
+    # choice point reached after max_depth choices, if specified.
+    def _explore(self, algorithm, choices, max_depth):
+        stack = [(algorithm, choices, None)]
+        # Choice points whose subtree is still being explored, as [state key, prefix length, derivation suffixes]
+        open_frames = []
+
+        while len(stack) > 0:
+            algorithm, choices, alternative = stack.pop()
+
+            if algorithm is None:
+                key, _, suffixes = open_frames.pop()
+                if suffixes is not None:
+                    self._table.put(key, suffixes)
+                continue
+
+            if alternative is not None:
+                if alternative < len(algorithm.alternatives()) - 1:
+                    stack.append((algorithm, choices, alternative + 1))
+                    algorithm = algorithm.fork()
+
+                algorithm.go_forward(alternative)
+                choices = choices + [alternative]
+
+            self._run_to_choice(algorithm)
+
+            if not algorithm.in_choice_state():
+                derivation = Derivation(choices, algorithm.success(), algorithm.spellout())
+                self._record_derivation(open_frames, derivation)
+                yield choices, derivation
+            elif max_depth is not None and len(choices) >= max_depth:
+                for frame in open_frames:
+                    frame[2] = None
+                yield choices, None
+            elif self._table is None:
+                stack.append((algorithm, choices, 0))
+            else:
+                key = algorithm.state_key()
+
+                known_suffixes = self._table.get(key)
+                if known_suffixes is not None:
+                    for suffix, success, spellout in known_suffixes:
+                        derivation = Derivation(choices + list(suffix), success, spellout)
+                        self._record_derivation(open_frames, derivation)
+                        yield derivation.choices, derivation
+                    continue
+
+                open_frames.append([key, len(choices), []])
+                stack.append((None, None, None))
+                stack.append((algorithm, choices, 0))
+
+    def _record_derivation(self, open_frames, derivation):
+        for frame in open_frames:
+            _, prefix_length, suffixes = frame
+            if suffixes is None:
+                continue
+
+            if len(suffixes) >= self.max_table_entry_size:
+                frame[2] = None
+            else:
+                suffixes.append((derivation.choices[prefix_length:], derivation.success, derivation.spellout))
+
+    @staticmethod
+    def _run_to_choice(algorithm):
+        while algorithm.can_go_forward() and not algorithm.in_choice_state():
+            algorithm.go_forward()
+
+
+def _search_subtree(task):
+    setup_obj, table_size, prefix = task
+
+    search = DerivationSearch(Setup.from_json_obj(setup_obj), table_size)
+    algorithm = search.replay(prefix)
+
+    return [(derivation.choices, derivation.success,
+             [algorithm.lexicon_entry_id(entry) for entry in derivation.spellout])
+            for _, derivation in search._explore(algorithm, list(prefix), None)]
@@ -0,0 +1,59 @@
+# algorithm/LexiconIndex.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+
+# Maps the signature ID of every subtree in the lexicon to the (entry, extras) pairs it matches, sorted by extras.
+# Entries are partitioned beforehand by the conceptual series they are accessible from, so that lookups for a series
+# only ever see eligible entries.
+class LexiconIndex():
+    _subtrees = None
+    _partitions = None
+    _indexes = None
+
+    def __init__(self, lexicon):
+        self._subtrees = dict()
+        for item in lexicon:
+            item_tree_size = item.tree.root.subtree_size()
+
+            self._subtrees[item] = [(start_node.signature_id(), item_tree_size - start_node.subtree_size())
+                                    for start_node in item.tree.bfs()]
+
+        all_series = set(series for item in lexicon for series in item.conceptual_content)
+        all_series.add(None)
+
+        self._partitions = dict((series, [item for item in lexicon if LexiconIndex._is_accessible(item, series)])
+                                for series in all_series)
+        self._indexes = dict()
+
+    def accessible_entries(self, series):
+        return self._partitions.get(series, self._partitions[None])
+
+    def lookup(self, signature_id, series):
+        if series not in self._indexes:
+            self._indexes[series] = self._build_index(self.accessible_entries(series))
+
+        return self._indexes[series].get(signature_id, [])
+
+    def _build_index(self, entries):
+        index = dict()
+
+        for item in entries:
+            for key, extras in self._subtrees[item]:
+                if key not in index:
+                    index[key] = []
+
+                index[key].append((item, extras))
+
+        for matches in index.values():
+            matches.sort(key=lambda x: x[1])
+
+        return index
+
+    @staticmethod
+    def _is_accessible(item, series):
+        return len(item.conceptual_content) == 0 or series in item.conceptual_content
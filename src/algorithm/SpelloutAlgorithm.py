@@ -6,6 +6,7 @@
 #
 # Licensed under the GPL-3
 
+import bisect
 import copy
 
 from algorithm.Setup import Setup
@@ -16,6 +17,10 @@ from structures.tree.PhrasalNode import PhrasalNode
 from structures.tree.TraceNode import TraceNode
 from structures.LexiconEntry import LexiconEntry
 from algorithm.LexicalizationMatch import LexicalizationMatch
+from algorithm.LexiconIndex import LexiconIndex
+from algorithm.UndoJournal import UndoJournal
+from algorithm.Checkpoint import Checkpoint
+from algorithm.ChoiceVector import ChoiceVector
 
 
 MSG_NOTE = 'i'
@@ -26,6 +31,26 @@ HIGHLIGHT_DESTINATION = '>'
 HIGHLIGHT_SOURCE = '<'
 HIGHLIGHT_POINT = '*'
 
+UNDO_ACTIONS = [
+    '_undo_switch_state',
+    '_undo_set_last_choice',
+    '_undo_highlight_nodes',
+    '_undo_increment_round_counter',
+    '_undo_external_merge',
+    '_undo_lexicalization',
+    '_undo_node_move',
+    '_undo_log_messages',
+    # Only found in sessions saved by older versions
+    '_undo_highlight_node',
+    '_undo_log_message',
+]
+
+# Consecutive highlight changes keep the earliest previous value of each node; consecutive log pops add up
+UNDO_MERGERS = {
+    '_undo_highlight_nodes': lambda prev_args, args: (dict(args[0].items() + prev_args[0].items()),),
+    '_undo_log_messages': lambda prev_args, args: (prev_args[0] + args[0],),
+}
+
 
 class SpelloutAlgorithm():
     _setup = None
@@ -40,11 +65,28 @@ class SpelloutAlgorithm():
     _pending_moves = None
     _last_choice = None
 
-    _undo_info = None
+    _undo_journal = None
+    _path = None
+    _path_start = 0
+    _forgotten_choices = None
+    _choice_steps = None
+    _checkpoints = None
+    _checkpoint_steps = None
+    _checkpoint_interval = 64
 
-    _tree_clone = None
-    _node_clones = None
     _special_init_node_lexicon_entry = None
+    _lexicon_index = None
+    _lexicon_entry_ids = None
+
+    _tree_version = 0
+    _lexicon_version = 0
+    _match_cache = None
+
+    _node_order = None
+    _node_positions = None
+    _lexicalization_cursor = 0
+
+    _quiet = False
 
     def __init__(self):
         self._state = self._state_not_started
@@ -52,41 +94,92 @@ class SpelloutAlgorithm():
         self._highlighted_nodes = {}
         self._lexicalizations = {}
         self._pending_moves = {}
-        self._undo_info = []
+        self._undo_journal = UndoJournal(UNDO_ACTIONS, UNDO_MERGERS)
+        self._path = []
+        self._forgotten_choices = []
+        self._choice_steps = []
+        self._checkpoints = {}
+        self._checkpoint_steps = []
+        self._match_cache = {}
+
+    # The setup the algorithm was started with, which may differ from the one being edited since
+    def setup(self):
+        return self._setup
 
     def started(self):
         return self._state != self._state_not_started
 
+    def quiet(self):
+        return self._quiet
+
+    # In quiet mode the algorithm runs the same state machine but keeps no log, highlights or undo information, which
+    # makes it considerably faster when only the final result matters. Steps taken in quiet mode cannot be undone, so
+    # the choices made in it are forgotten when leaving it.
+    def set_quiet(self, quiet):
+        if quiet and not self._quiet:
+            self._undo_journal.clear()
+            self._highlighted_nodes = {}
+            self._reset_history()
+
+        was_quiet = self._quiet
+        self._quiet = quiet
+
+        if was_quiet and not quiet and self.started():
+            self._last_choice = None
+            self._reset_history()
+            self._take_checkpoint()
+
+    # The returned tree is a copy-on-write snapshot; nodes in the dictionaries below refer to the same snapshot
     def tree(self):
-        return self._tree_clone
+        return Tree(self._tree.root.snapshot()) if self._tree is not None else None
 
     def highlighted_nodes(self):
-        return dict((self._node_clones[node], highlight) for node, highlight in self._highlighted_nodes.items())
+        return dict((node.snapshot(), highlight) for node, highlight in self._highlighted_nodes.items())
 
     def lexicalizations(self):
-        return dict((self._node_clones[node], lexicon_entry) for node, lexicon_entry in self._lexicalizations.items())
+        return dict((node.snapshot(), lexicon_entry) for node, lexicon_entry in self._lexicalizations.items())
 
     def pending_moves(self):
-        return dict((self._node_clones[node], self._node_clones[destination])
-                    for node, destination in self._pending_moves.items())
+        return dict((node.snapshot(), destination.snapshot()) for node, destination in self._pending_moves.items())
 
     def log(self):
         return [message for message in self._log]
 
     def alternatives(self):
         if self._state == self._state_list_matches:
-            node = self._first_nonlexicalized_node()
-
-            return [(match.description(), index) for index, match in enumerate(self._matches_for_node(node))]
+            return [(match.description(), index) for index, match in enumerate(self.matches())]
 
         return [('Default', None)]
 
+    def matches(self):
+        if self._state == self._state_list_matches:
+            return list(self._matches_for_node(self._first_nonlexicalized_node()))
+
+        return []
+
     def last_choice(self):
         return self._last_choice
 
     def in_choice_state(self):
         return self._state == self._state_list_matches and len(self.alternatives()) > 1
 
+    # Steps at which a choice between several alternatives was made, oldest first. Choices made in quiet mode are not
+    # included.
+    def choice_steps(self):
+        return list(self._choice_steps)
+
+    # The alternatives taken at the choice steps above. Together with the setup, this identifies the derivation so
+    # far, provided the history goes back to the start.
+    def choice_vector(self):
+        alternatives = self._forgotten_choices + [self._path[step - self._path_start]
+                                                  for step in self._choice_steps[len(self._forgotten_choices):]]
+
+        return ChoiceVector(alternative if alternative is not None else 0 for alternative in alternatives)
+
+    # Goes back to the choice state at the given index in choice_steps(), -1 being the most recent one
+    def go_to_choice(self, index=-1):
+        self.go_to_step(self._choice_steps[index])
+
     def success(self):
         return self._state == self._state_success
 
@@ -94,8 +187,10 @@ class SpelloutAlgorithm():
         setup.check()
         self._setup = setup.clone()
         self._regen_special_init_node_lexicon_entry()
+        self._rebuild_lexicon_index()
 
         self._switch_state(self._state_just_started, {})
+        self._take_checkpoint()
 
     def can_go_forward(self):
         return self._state not in [self._state_not_started, self._state_failure, self._state_success]
@@ -104,20 +199,77 @@ class SpelloutAlgorithm():
         if not self.can_go_forward():
             raise RuntimeError("The algorithm cannot go forward from this point")
 
+        self._record_path_step(alternative)
         self._new_undo_point()
         next_state, state_entry_args = self._get_next_state(alternative)
 
         self._switch_state(next_state, state_entry_args)
+        self._take_due_checkpoint()
 
     def can_go_back(self):
-        return len(self._undo_info) > 0
+        return len(self._undo_journal) > 0 or self._nearest_checkpoint(self.current_step() - 1) is not None
 
     def go_back(self):
-        actions = self._undo_info.pop()
+        if len(self._undo_journal) == 0:
+            self.go_to_step(self.current_step() - 1)
+            return
+
+        for action_name, args in reversed(self._undo_journal.pop_step()):
+            getattr(self, action_name)(*args)
+
+    # Steps are counted from the start of the algorithm (or from the point where it was loaded or left quiet mode).
+    # Steps after the current one are remembered until a different alternative is taken, so one can also jump
+    # forward to them.
+    def current_step(self):
+        return self._undo_journal.dropped_steps + len(self._undo_journal)
+
+    def step_count(self):
+        return self._path_start + len(self._path)
+
+    # Steps after the current one can always be redone. Earlier ones need undo history or a checkpoint, which may have
+    # been let go under an undo limit.
+    def can_reach_step(self, step):
+        if step < 0 or step > self.step_count():
+            return False
+
+        return step >= self._undo_journal.dropped_steps or self._nearest_checkpoint(step) is not None
+
+    # Jumps back to any reachable step by restoring the nearest checkpoint before it and replaying the rest of the
+    # way, unless simply undoing steps is cheaper. Jumps forward redo the remembered steps, so that the undo history
+    # (which is what gets saved) always reaches back as far as before.
+    def go_to_step(self, step):
+        if self._quiet:
+            raise RuntimeError("Cannot jump to a step in quiet mode")
+        if step < 0 or step > self.step_count():
+            raise RuntimeError("Invalid step: {0}".format(step))
+
+        current_step = self.current_step()
+        checkpoint = self._nearest_checkpoint(step)
+
+        if step <= current_step:
+            can_undo = step >= self._undo_journal.dropped_steps
+            if checkpoint is None and not can_undo:
+                raise RuntimeError("Step {0} can no longer be reached".format(step))
+
+            if checkpoint is None or (can_undo and current_step - step <= step - checkpoint.step):
+                while self.current_step() > step:
+                    self.go_back()
+                return
+
+            self._restore_checkpoint(checkpoint)
 
-        while len(actions) > 0:
-            action, args = actions.pop()
-            action(*args)
+        while self.current_step() < step:
+            self.go_forward(self._path[self.current_step() - self._path_start])
+
+    # Checkpoints are taken every that many steps; None disables them
+    def set_checkpoint_interval(self, interval):
+        self._checkpoint_interval = interval
+
+    # Limits how many steps can be undone, so that the undo history of a long session stops growing. None means no
+    # limit. Checkpoints and remembered alternatives for steps out of reach are let go as well.
+    def set_undo_limit(self, max_steps):
+        self._undo_journal.set_max_steps(max_steps)
+        self._forget_unreachable_history()
 
     def spellout(self):
         parts = []
@@ -125,21 +277,102 @@ class SpelloutAlgorithm():
 
         return parts
 
+    # Lexicon entries used by the algorithm are identified by their index in the setup lexicon, or 'INIT' for the
+    # entry standing for the initial node
+    def lexicon_entry_id(self, entry):
+        if entry == self._special_init_node_lexicon_entry:
+            return 'INIT'
+
+        if entry not in self._lexicon_entry_ids:
+            raise RuntimeError(u"Lexicon entry {0} is not in the lexicon".format(entry.name))
+
+        return self._lexicon_entry_ids[entry]
+
+    def lexicon_entry_by_id(self, entry_id):
+        if entry_id == 'INIT':
+            return self._special_init_node_lexicon_entry
+
+        if entry_id < 0 or entry_id >= len(self._setup.lexicon):
+            raise RuntimeError("Invalid lexicon item index: {0}".format(entry_id))
+
+        return self._setup.lexicon[entry_id]
+
+    # Returns a hashable key that is equal for two states iff the rest of their derivations are bound to be the same,
+    # i.e. same state, round, tree shape, lexicalizations and pending moves. Logs and highlights are not included.
+    def state_key(self):
+        if self._tree is None:
+            return self._get_state_name(self._state), self._external_merge_round, None
+
+        nodes = list(self._tree.bfs())
+        ids = dict((node, index) for index, node in enumerate(nodes))
+        ids[None] = None
+
+        node_keys = []
+        for node in nodes:
+            if isinstance(node, TraceNode):
+                node_key = ('TraceNode', ids.get(node.of_node))
+            else:
+                node_key = (node.__class__.__name__, node.name())
+
+            if node in self._lexicalizations:
+                entry = self._lexicalizations[node]
+                lexicalization = (self.lexicon_entry_id(entry) if entry is not None else None,)
+            else:
+                lexicalization = ()
+
+            node_keys.append((node_key, ids[node.left], ids[node.right], lexicalization,
+                              ids.get(self._pending_moves.get(node))))
+
+        return self._get_state_name(self._state), self._external_merge_round, tuple(node_keys)
+
+    # Returns an independent copy of the current derivation state that shares the (read-only) setup and lexicon
+    # index with this one. The copy starts with an empty undo history.
+    def fork(self):
+        dupe = SpelloutAlgorithm()
+        dupe._setup = self._setup
+        dupe._special_init_node_lexicon_entry = self._special_init_node_lexicon_entry
+        dupe._lexicon_index = self._lexicon_index
+        dupe._lexicon_entry_ids = self._lexicon_entry_ids
+        dupe._lexicon_version = self._lexicon_version
+
+        mapping = {}
+        dupe._tree = self._tree.clone(mapping) if self._tree is not None else None
+
+        dupe._state = getattr(dupe, self._state.__name__)
+        dupe._external_merge_round = self._external_merge_round
+        dupe._quiet = self._quiet
+        dupe._log = list(self._log) if not self._quiet else []
+        dupe._last_choice = self._last_choice
+        dupe._highlighted_nodes = dict((mapping[node], highlight)
+                                       for node, highlight in self._highlighted_nodes.items())
+        dupe._lexicalizations = dict((mapping[node], entry) for node, entry in self._lexicalizations.items())
+        dupe._pending_moves = dict((mapping[node], mapping[destination])
+                                   for node, destination in self._pending_moves.items())
+
+        return dupe
+
     def to_json_obj(self):
-        REF = self._references_to_json
+        node_ids = self._node_ids()
+        REF = lambda value: self._references_to_json(value, node_ids)
         MAT = self._materialize_to_json
 
         obj = {
             'setup': self._setup.to_json_obj(),
             'state': REF(self._state),
             'external_merge_round': self._external_merge_round,
-            'tree': MAT(self._tree),
+            'tree': self._tree.to_json_obj(node_ids) if self._tree is not None else None,
             'log': MAT(self._log),
             'last_choice': self._last_choice,
             'highlights': REF(self._highlighted_nodes),
             'lexicalizations': REF(self._lexicalizations),
             'pending_moves': REF(self._pending_moves),
-            'undo_info': REF(self._undo_info)
+            'undo_info': [[('@action:' + action_name, REF(args)) for action_name, args in step]
+                          for step in self._undo_journal.steps()],
+            # Alternatives taken from the oldest undoable step on, including remembered steps after the current one
+            'path': self._path[self._undo_journal.dropped_steps - self._path_start:],
+            # Choices made before that step, as [step, alternative], with steps counted from it (i.e. negative)
+            'forgotten_choices': [[step - self._undo_journal.dropped_steps, alternative]
+                                  for step, alternative in zip(self._choice_steps, self._forgotten_choices)]
         }
 
         return obj
@@ -202,7 +435,7 @@ class SpelloutAlgorithm():
 
     def _state_just_started(self, **_):
         self._tree = Tree(self._setup.initial_node)
-        self._update_tree_clone()
+        self._on_tree_changed()
 
         self._external_merge_round = 0
         self._log = []
@@ -210,45 +443,46 @@ class SpelloutAlgorithm():
         self._lexicalizations = {}
         self._pending_moves = {}
         self._log_note("Algorithm started.")
-        self._log_note("Initial tree consists of node {0}".format(self._setup.initial_node.name()))
+        self._log_note("Initial tree consists of node {0}", self._setup.initial_node.name())
         if isinstance(self._setup.initial_node, PhrasalNode):
             self._lexicalizations[self._setup.initial_node] = self._special_init_node_lexicon_entry
             self._log_note("Initial node is already lexicalized")
-        self._undo_info = []
+        self._undo_journal.clear()
+        self._reset_history()
         self._last_choice = None
 
     def _state_begin_merge_round(self, **_):
         self._increment_round_counter()
         self._clear_highlighting()
-        self._log_note(u"Beginning of {0}".format(self._current_round_name()))
+        self._log_note(u"Beginning of {0}", self._current_round_name())
 
     def _state_announce_move(self, **_):
         node = self._first_node_to_move()
         destination = self._pending_moves[node]
         self._highlight_nodes({node: HIGHLIGHT_SOURCE, destination: HIGHLIGHT_DESTINATION})
-        self._log_note(u"About to move node {0}".format(node.name()))
+        self._log_note(u"About to move node {0}", node.name())
 
     def _state_moved_node(self, **_):
         node = self._first_node_to_move()
         self._do_node_move(node)
         self._highlight_nodes({node: HIGHLIGHT_DESTINATION})
-        self._log_note(u"Moved node {0}".format(node.name()))
+        self._log_note(u"Moved node {0}", node.name())
 
     def _state_announce_external_merge(self, **_):
         node = self._setup.external_merges[self._external_merge_round - 1]
         self._highlight_nodes({self._tree.root: HIGHLIGHT_DESTINATION})
-        self._log_note(u"About to perform external merge of node {0}".format(node.name()))
+        self._log_note(u"About to perform external merge of node {0}", node.name())
 
     def _state_merged_node(self, **_):
         node = self._setup.external_merges[self._external_merge_round - 1]
         merged_node = self._do_external_merge(node)
         self._highlight_nodes({merged_node: HIGHLIGHT_POINT})
-        self._log_note(u"Merged node {0}".format(node.name()))
+        self._log_note(u"Merged node {0}", node.name())
 
     def _state_announce_lexicalization(self, **_):
         node = self._first_nonlexicalized_node()
         self._highlight_nodes({node: HIGHLIGHT_POINT})
-        self._log_note(u"About to lexicalize node {0}".format(node.name()))
+        self._log_note(u"About to lexicalize node {0}", node.name())
 
     def _state_list_matches(self, **_):
         node = self._first_nonlexicalized_node()
@@ -256,7 +490,8 @@ class SpelloutAlgorithm():
 
         matches = self._matches_for_node(node)
         if len(matches) > 0:
-            self._log_note(u"Matches: {0}".format(', '.join(match.description() for match in matches)))
+            if not self._quiet:
+                self._log_note(u"Matches: {0}", ', '.join(match.description() for match in matches))
         else:
             self._log_warning("No matches for this node")
 
@@ -277,8 +512,7 @@ class SpelloutAlgorithm():
             if len(matches) > 1:
                 self._set_last_choice(alternative)
 
-            self._log_note(u"Lexicalized node {0} using item {1}".format(node.name(),
-                                                                         matches[alternative].lexicon_entry.name))
+            self._log_note(u"Lexicalized node {0} using item {1}", node.name(), matches[alternative].lexicon_entry.name)
 
     def _state_lexicalization_done(self, **_):
         self._clear_highlighting()
@@ -286,17 +520,17 @@ class SpelloutAlgorithm():
 
     def _state_end_merge_round(self, **_):
         self._clear_highlighting()
-        self._log_note("End of {0}".format(self._current_round_name()))
+        self._log_note("End of {0}", self._current_round_name())
 
     def _state_success(self, **_):
         self._clear_highlighting()
         self._log_note("Algorithm completed successfully")
 
-        spellout = self.spellout()
-        self._log_note(u"Spell-out: {0} (/{1}/)".format(
-            u'+'.join(item.name for item in spellout),
-            u' '.join(item.phonological_content for item in spellout)
-        ))
+        if not self._quiet:
+            spellout = self.spellout()
+            self._log_note(u"Spell-out: {0} (/{1}/)",
+                           u'+'.join(item.name for item in spellout),
+                           u' '.join(item.phonological_content for item in spellout))
 
     def _state_failure(self, **kwargs):
         self._log_error(u"FAILURE: " + kwargs['error_text'])
@@ -316,24 +550,51 @@ class SpelloutAlgorithm():
     def _any_to_lexicalize(self):
         return self._first_nonlexicalized_node() is not None
 
+    # Nodes before the cursor in the worklist are known not to need lexicalization. The cursor only moves back when
+    # a lexicalization is undone, so finding the next node costs O(1) amortized.
     def _first_nonlexicalized_node(self):
-        for index, node in enumerate(reversed(list(self._tree.bfs()))):
-            if self._node_is_lexicalized(node) or isinstance(node, TraceNode):
-                continue
-            # Special: the root does not need to be lexicalized in the final cycle
-            if node == self._tree.root and self._is_final_round():
-                continue
+        self._update_worklist()
+
+        while self._lexicalization_cursor < len(self._node_order):
+            node = self._node_order[self._lexicalization_cursor]
+            if self._needs_lexicalization(node):
+                return node
 
-            return node
+            self._lexicalization_cursor += 1
 
         return None
 
     def _first_node_to_move(self):
-        for node in reversed(list(self._tree.bfs())):
-            if node in self._pending_moves:
-                return node
+        if len(self._pending_moves) == 0:
+            return None
 
-        return None
+        self._update_worklist()
+
+        return min(self._pending_moves, key=lambda node: self._node_positions[node])
+
+    def _needs_lexicalization(self, node):
+        if self._node_is_lexicalized(node) or isinstance(node, TraceNode):
+            return False
+        # Special: the root does not need to be lexicalized in the final cycle
+        if node == self._tree.root and self._is_final_round():
+            return False
+
+        return True
+
+    # The worklist holds the nodes in reverse BFS order, i.e. the order in which they are lexicalized and moved. It
+    # is rebuilt lazily whenever the tree structure changes.
+    def _update_worklist(self):
+        if self._node_order is not None:
+            return
+
+        self._node_order = list(self._tree.bfs())
+        self._node_order.reverse()
+        self._node_positions = dict((node, index) for index, node in enumerate(self._node_order))
+        self._lexicalization_cursor = 0
+
+    def _rewind_worklist(self, node):
+        if self._node_order is not None:
+            self._lexicalization_cursor = min(self._lexicalization_cursor, self._node_positions.get(node, 0))
 
     def _node_is_lexicalized(self, node):
         return node in self._lexicalizations
@@ -350,46 +611,31 @@ class SpelloutAlgorithm():
             self._spellout_rec(child, parts)
 
     def _matches_for_node(self, node):
-        matches = self._matches_without_movement(node)
-        matches.extend(self._matches_with_one_movement(node))
+        key = (node, self._tree_version, self._lexicon_version, self._setup.conceptual_series)
 
-        return matches
+        matches = self._match_cache.get(key)
+        if matches is None:
+            matches = self._matches_without_movement(node)
+            matches.extend(self._matches_with_one_movement(node))
+            self._match_cache[key] = matches
 
-    def _accessible_lexicon(self):
-        for item in self._setup.lexicon:
-            if len(item.conceptual_content) == 0 or self._setup.conceptual_series in item.conceptual_content:
-                yield item
+        return matches
 
     def _matches_without_movement(self, node):
-        matches = []
-
-        node_sig = node.signature()
-        for item in self._accessible_lexicon():
-            item_tree_size = item.tree.root.subtree_size()
-
-            for start_node in item.tree.bfs():
-                if start_node.signature() == node_sig:
-                    matches.append(LexicalizationMatch(item, item_tree_size - start_node.subtree_size()))
-
-        matches.sort(key=lambda x: x.extras)
-
-        return matches
+        return self._matches_for_signature(node.signature_id())
 
     def _matches_with_one_movement(self, node):
         matches = []
 
-        for parent in node.bfs():
-            for side in (0, 1):
-                if parent.get_child(side) is not None:
-                    temp = parent.get_child(side)
-                    parent.set_child(side, None)
-                    for m in self._matches_without_movement(node):
-                        m.moved = temp
-                        matches.append(m)
-                    parent.set_child(side, temp)
+        for parent, side, signature_id in node.signatures_without_one_subtree():
+            matches.extend(self._matches_for_signature(signature_id, parent.get_child(side)))
 
         return matches
 
+    def _matches_for_signature(self, signature_id, moved=None):
+        return [LexicalizationMatch(item, extras, moved)
+                for item, extras in self._lexicon_index.lookup(signature_id, self._setup.conceptual_series)]
+
     def _switch_state(self, next_state, state_entry_args):
         next_state(**state_entry_args)
 
@@ -401,20 +647,25 @@ class SpelloutAlgorithm():
         self._highlight_nodes({})
 
     def _highlight_nodes(self, highlight_now):
+        if self._quiet:
+            return
+
+        prev_values = {}
         removed = set(self._highlighted_nodes.keys()) - set(highlight_now.keys())
 
         for item in removed:
-            prev_value = self._highlighted_nodes[item]
-            self._add_undo_action(self._undo_highlight_node, item, prev_value)
+            prev_values[item] = self._highlighted_nodes[item]
             del self._highlighted_nodes[item]
 
         for item in highlight_now:
             if item in self._highlighted_nodes and self._highlighted_nodes[item] == highlight_now[item]:
                 continue
 
-            prev_value = self._highlighted_nodes.get(item)
+            prev_values[item] = self._highlighted_nodes.get(item)
             self._highlighted_nodes[item] = highlight_now[item]
-            self._add_undo_action(self._undo_highlight_node, item, prev_value)
+
+        if len(prev_values) > 0:
+            self._add_undo_action(self._undo_highlight_nodes, prev_values)
 
     def _increment_round_counter(self):
         self._external_merge_round += 1
@@ -423,7 +674,7 @@ class SpelloutAlgorithm():
     def _do_external_merge(self, merged_node):
         merged_node = merged_node.clone()
         self._tree.root = PhrasalNode(merged_node.feature, 0, merged_node, self._tree.root)
-        self._update_tree_clone()
+        self._on_tree_changed()
 
         self._add_undo_action(self._undo_external_merge)
 
@@ -437,7 +688,7 @@ class SpelloutAlgorithm():
             raise RuntimeError(u"Cannot move root node {0}!".format(node.name()))
 
         destination = self._pending_moves[node]
-        self._add_undo_action(self._undo_node_move, node, destination, src_parent, src_side)
+        self._add_undo_action(self._undo_node_move, node, destination, src_parent, src_side, destination.degree)
 
         src_parent.set_child(src_side, TraceNode(node))
 
@@ -454,7 +705,7 @@ class SpelloutAlgorithm():
         else:
             dest_parent.set_child(dest_side, phrasal)
 
-        self._update_tree_clone()
+        self._on_tree_changed()
 
         del self._pending_moves[node]
 
@@ -479,47 +730,169 @@ class SpelloutAlgorithm():
         self._last_choice = choice
         self._add_undo_action(self._undo_set_last_choice, prev_choice)
 
-    def _log_message(self, kind, message):
-        self._log.append((kind, message))
-        self._add_undo_action(self._undo_log_message)
+        if not self._quiet:
+            self._choice_steps.append(self.current_step() - 1)
 
-    def _log_note(self, message):
-        self._log_message(MSG_NOTE, message)
+    def _log_message(self, kind, message, *args):
+        if self._quiet:
+            return
 
-    def _log_warning(self, message):
-        self._log_message(MSG_WARNING, message)
+        self._log.append((kind, message.format(*args) if len(args) > 0 else message))
+        self._add_undo_action(self._undo_log_messages, 1)
 
-    def _log_error(self, message):
-        self._log_message(MSG_ERROR, message)
+    def _log_note(self, message, *args):
+        self._log_message(MSG_NOTE, message, *args)
+
+    def _log_warning(self, message, *args):
+        self._log_message(MSG_WARNING, message, *args)
+
+    def _log_error(self, message, *args):
+        self._log_message(MSG_ERROR, message, *args)
 
     def _new_undo_point(self):
-        self._undo_info.append([])
+        if not self._quiet:
+            self._undo_journal.new_step()
+            self._forget_unreachable_history()
 
     def _add_undo_action(self, action, *args):
-        if len(self._undo_info) > 0:
-            self._undo_info[-1].append((action, args))
+        if not self._quiet:
+            self._undo_journal.add(action.__name__, args)
+
+    def _record_path_step(self, alternative):
+        if self._quiet:
+            return
+
+        step = self.current_step()
+        index = step - self._path_start
+        if index < len(self._path) and self._path[index] == alternative:
+            return
+
+        del self._path[index:]
+        self._path.append(alternative)
+
+        first_later = bisect.bisect_right(self._checkpoint_steps, step)
+        for checkpoint_step in self._checkpoint_steps[first_later:]:
+            del self._checkpoints[checkpoint_step]
+        del self._checkpoint_steps[first_later:]
+
+    def _reset_history(self):
+        self._path = []
+        self._path_start = 0
+        self._forgotten_choices = []
+        self._checkpoints = {}
+        self._checkpoint_steps = []
+        self._choice_steps = []
+
+    # With an undo limit, steps before the oldest undoable one can no longer be reached, so the checkpoints and path
+    # entries for them are dropped. The alternatives taken at choice steps among them are still needed for
+    # choice_vector() and are kept apart.
+    def _forget_unreachable_history(self):
+        oldest_step = self._undo_journal.dropped_steps
+        if self._undo_journal.max_steps is None or oldest_step <= self._path_start:
+            return
+
+        first_kept = bisect.bisect_left(self._checkpoint_steps, oldest_step)
+        for checkpoint_step in self._checkpoint_steps[:first_kept]:
+            del self._checkpoints[checkpoint_step]
+        del self._checkpoint_steps[:first_kept]
+
+        forgotten_count = bisect.bisect_left(self._choice_steps, oldest_step)
+        for step in self._choice_steps[len(self._forgotten_choices):forgotten_count]:
+            self._forgotten_choices.append(self._path[step - self._path_start])
+
+        del self._path[:oldest_step - self._path_start]
+        self._path_start = oldest_step
+
+    # Checkpoints are also retaken when passing through their step again, as replaying creates new nodes that the
+    # undo journal will refer to
+    def _take_due_checkpoint(self):
+        if self._quiet or self._checkpoint_interval is None:
+            return
+
+        step = self.current_step()
+        if step % self._checkpoint_interval == 0 or step in self._checkpoints:
+            self._take_checkpoint()
+
+    def _take_checkpoint(self):
+        if self._quiet or self._tree is None:
+            return
+
+        step = self.current_step()
+        structure = [(node, node.left, node.right, node.degree if isinstance(node, PhrasalNode) else None)
+                     for node in self._tree.bfs()]
+
+        if step not in self._checkpoints:
+            bisect.insort(self._checkpoint_steps, step)
+
+        self._checkpoints[step] = Checkpoint(step, self._state, self._external_merge_round, self._last_choice,
+                                             list(self._choice_steps), self._tree.root, structure,
+                                             dict(self._highlighted_nodes), dict(self._lexicalizations),
+                                             dict(self._pending_moves), len(self._log))
+
+    def _nearest_checkpoint(self, step):
+        index = bisect.bisect_right(self._checkpoint_steps, step)
+
+        return self._checkpoints[self._checkpoint_steps[index - 1]] if index > 0 else None
+
+    # Only checkpoints at or before the current step are restored, so the log there is a prefix of the current one
+    def _restore_checkpoint(self, checkpoint):
+        for node, left, right, degree in checkpoint.structure:
+            node.left = left
+            node.right = right
+            if degree is not None and node.degree != degree:
+                node.degree = degree
+
+        root = checkpoint.root
+        if root.parent() is not None:
+            root.parent().set_child(root.side_in_parent(), None)
+
+        self._tree.root = root
+        self._on_tree_changed()
+
+        self._state = checkpoint.state
+        self._external_merge_round = checkpoint.external_merge_round
+        self._last_choice = checkpoint.last_choice
+        self._choice_steps = list(checkpoint.choice_steps)
+        self._highlighted_nodes = dict(checkpoint.highlighted_nodes)
+        self._lexicalizations = dict(checkpoint.lexicalizations)
+        self._pending_moves = dict(checkpoint.pending_moves)
+
+        del self._log[checkpoint.log_length:]
+
+        self._undo_journal.truncate(checkpoint.step)
+        self._forget_unreachable_history()
 
     def _undo_switch_state(self, prev_state):
         self._state = prev_state
 
     def _undo_set_last_choice(self, prev_choice):
         self._last_choice = prev_choice
+        self._choice_steps.pop()
 
+    # Merged records may restore "no highlight" on a node that has none by now
     def _undo_highlight_node(self, node, prev_value):
         if prev_value is None:
-            del self._highlighted_nodes[node]
+            self._highlighted_nodes.pop(node, None)
         else:
             self._highlighted_nodes[node] = prev_value
 
+    def _undo_highlight_nodes(self, prev_values):
+        for node, prev_value in prev_values.items():
+            self._undo_highlight_node(node, prev_value)
+
     def _undo_increment_round_counter(self):
         self._external_merge_round -= 1
+        self._rewind_worklist(self._tree.root)
 
     def _undo_external_merge(self):
-        self._tree.root = self._tree.root.right
-        self._update_tree_clone()
+        merged_root = self._tree.root
+        self._tree.root = merged_root.right
+        merged_root.right = None
+        self._on_tree_changed()
 
     def _undo_lexicalization(self, node, moved_node, prev_destination):
         del self._lexicalizations[node]
+        self._rewind_worklist(node)
 
         if moved_node is not None:
             if prev_destination is not None:
@@ -527,7 +900,8 @@ class SpelloutAlgorithm():
             else:
                 del self._pending_moves[moved_node]
 
-    def _undo_node_move(self, node, destination, src_parent, src_side):
+    # Records from older sessions lack the previous degree; a degree of 1 could then only have come from 0
+    def _undo_node_move(self, node, destination, src_parent, src_side, prev_degree=None):
         phrasal, _ = self._tree.locate_node(destination)
         ph_parent, ph_side = self._tree.locate_node(phrasal)
 
@@ -536,26 +910,28 @@ class SpelloutAlgorithm():
         else:
             ph_parent.set_child(ph_side, destination)
 
-        destination.degree -= 1
-        if destination.degree == 1:
+        if prev_degree is not None:
+            destination.degree = prev_degree
+        elif destination.degree == 1:
             destination.degree = 0
 
         src_parent.set_child(src_side, node)
 
         self._pending_moves[node] = destination
 
-        self._update_tree_clone()
+        self._on_tree_changed()
 
     def _undo_log_message(self):
         self._log.pop()
 
-    def _update_tree_clone(self):
-        if self._tree is not None:
-            self._tree_clone = self._tree.clone()
-            self._node_clones = dict(zip(self._tree.bfs(), self._tree_clone.bfs()))
-        else:
-            self._tree_clone = None
-            self._node_clones = {}
+    def _undo_log_messages(self, count):
+        del self._log[len(self._log) - count:]
+
+    # Matches computed for an older version of the tree can never be looked up again
+    def _on_tree_changed(self):
+        self._tree_version += 1
+        self._match_cache.clear()
+        self._node_order = None
 
     def _regen_special_init_node_lexicon_entry(self):
         if self._setup.initial_node is None:
@@ -569,24 +945,86 @@ class SpelloutAlgorithm():
             Tree(self._setup.initial_node)
         )
 
-    def _load_from_json_obj(self, data):
-        REF = self._references_from_json
+    def _rebuild_lexicon_index(self):
+        self._lexicon_index = LexiconIndex(self._setup.lexicon)
+        self._lexicon_version += 1
 
+        self._lexicon_entry_ids = dict()
+        for index, entry in enumerate(self._setup.lexicon):
+            self._lexicon_entry_ids.setdefault(entry, index)
+        self._match_cache.clear()
+
+    def _load_from_json_obj(self, data):
         self._setup = Setup.from_json_obj(data['setup'])
         self._regen_special_init_node_lexicon_entry()
+        self._rebuild_lexicon_index()
 
-        self._tree = Tree.from_json_obj(data['tree'])
+        nodes = []
+        self._tree = Tree.from_json_obj(data['tree'], nodes)
         self._log = copy.deepcopy(data['log'])
 
+        REF = lambda value: self._references_from_json(value, nodes)
+
         self._state = REF(data['state'])
         self._last_choice = data['last_choice']
         self._external_merge_round = data['external_merge_round']
         self._lexicalizations = REF(data['lexicalizations'])
         self._pending_moves = REF(data['pending_moves'])
-        self._highlights = REF(data['highlights'])
-        self._undo_info = REF(data['undo_info'])
+        self._highlighted_nodes = REF(data['highlights'])
+        self._load_undo_journal(data['undo_info'], nodes)
+
+        self._on_tree_changed()
+
+        self._reset_history()
+        self._path, self._choice_steps = self._choices_from_undo_info(data['undo_info'])
+        if len(data.get('path', [])) > len(self._path):
+            self._path = list(data['path'])
+
+        forgotten_choices = data.get('forgotten_choices', [])
+        self._forgotten_choices = [alternative for _, alternative in forgotten_choices]
+        self._choice_steps[:0] = [step for step, _ in forgotten_choices]
+        self._take_checkpoint()
+
+    # The undo history is only decoded once it is needed (going back past the point where the session was loaded,
+    # saving, ...), so that loading a long session does not have to resolve all of it. The references in it are to
+    # nodes as they were at loading time, which is why the node list is kept until then.
+    def _load_undo_journal(self, data, nodes):
+        self._undo_journal.clear()
+        self._undo_journal.defer_steps(data, lambda step: self._undo_records_from_json(step, nodes))
+
+    def _undo_records_from_json(self, step, nodes):
+        records = []
+
+        for action_ref, args in step:
+            if not action_ref.startswith('@action:'):
+                raise RuntimeError("No such action: '{0}'".format(action_ref))
+
+            records.append((action_ref[len('@action:'):], tuple(self._references_from_json(args, nodes))))
+
+        return records
+
+    # Returns the alternative taken at each step, and the steps where a choice was made. The alternative only
+    # matters where a choice was recorded, and it is the same as the last choice right after that step. Works on the
+    # serialized undo history, as the previous choices recorded in it are plain values.
+    def _choices_from_undo_info(self, undo_info):
+        choices = []
+        choice_steps = []
+        choice = self._last_choice
+
+        for index in xrange(len(undo_info) - 1, -1, -1):
+            prev_choices = [args[0] for action_ref, args in undo_info[index]
+                            if action_ref == '@action:_undo_set_last_choice']
+            if len(prev_choices) > 0:
+                choices.append(choice)
+                choice_steps.append(index)
+                choice = prev_choices[0]
+            else:
+                choices.append(None)
+
+        choices.reverse()
+        choice_steps.reverse()
 
-        self._update_tree_clone()
+        return choices, choice_steps
 
     def _materialize_to_json(self, value):
         if isinstance(value, list) or isinstance(value, tuple) or isinstance(value, set):
@@ -596,23 +1034,26 @@ class SpelloutAlgorithm():
         else:
             return value
 
-    def _references_to_json(self, value):
+    # Nodes are referred to by their 1-based position in a BFS of the tree, same as in Tree.to_json_obj()
+    def _node_ids(self):
+        if self._tree is None:
+            return dict()
+
+        return dict((node, node_idx + 1) for node_idx, node in enumerate(self._tree.bfs()))
+
+    def _references_to_json(self, value, node_ids):
         if isinstance(value, list) or isinstance(value, tuple) or isinstance(value, set):
-            return [self._references_to_json(item) for item in value]
+            return [self._references_to_json(item, node_ids) for item in value]
         elif isinstance(value, dict):
-            return dict((self._references_to_json(key), self._references_to_json(val))
+            return dict((self._references_to_json(key, node_ids), self._references_to_json(val, node_ids))
                         for key, val in value.items())
         elif isinstance(value, TreeNode):
-            for node_idx, node in enumerate(self._tree.bfs()):
-                if value == node:
-                    return '@node:{0}'.format(node_idx + 1)
+            if value not in node_ids:
+                raise RuntimeError("Tried to refer to node not in tree")
 
-            raise RuntimeError("Tried to refer to node not in tree")
+            return '@node:{0}'.format(node_ids[value])
         elif isinstance(value, LexiconEntry):
-            if value == self._special_init_node_lexicon_entry:
-                return '@lexicon:INIT'
-
-            return '@lexicon:{0}'.format(self._setup.lexicon.index(value))
+            return '@lexicon:{0}'.format(self.lexicon_entry_id(value))
         elif callable(value):
             if value.__name__.startswith('_state_'):
                 return '@state:' + self._get_state_name(value)
@@ -621,7 +1062,7 @@ class SpelloutAlgorithm():
         else:
             return value
 
-    def _references_from_json(self, data):
+    def _references_from_json(self, data, nodes):
         if data is None:
             return None
         elif isinstance(data, basestring):
@@ -639,24 +1080,18 @@ class SpelloutAlgorithm():
                 return getattr(self, name)
             elif data.startswith('@node:'):
                 index = int(data[len('@node:'):])
-                all_nodes = list(self._tree.bfs())
-                if index < 1 or index > len(all_nodes):
+                if index < 1 or index > len(nodes):
                     raise RuntimeError("Invalid node ID: {0}".format(index))
 
-                return all_nodes[index - 1]
+                return nodes[index - 1]
             elif data.startswith('@lexicon:'):
-                if data == '@lexicon:INIT':
-                    return self._special_init_node_lexicon_entry
-
-                index = int(data[len('@lexicon:'):])
-                if index < 0 or index >= len(self._setup.lexicon):
-                    raise RuntimeError("Invalid lexicon item index: {0}".format(index))
+                entry_id = data[len('@lexicon:'):]
 
-                return self._setup.lexicon[index]
+                return self.lexicon_entry_by_id(entry_id if entry_id == 'INIT' else int(entry_id))
         elif isinstance(data, dict):
-            return dict((self._references_from_json(key), self._references_from_json(val))
+            return dict((self._references_from_json(key, nodes), self._references_from_json(val, nodes))
                         for key, val in data.items())
         elif isinstance(data, list):
-            return [self._references_from_json(item) for item in data]
+            return [self._references_from_json(item, nodes) for item in data]
 
         return data
@@ -0,0 +1,192 @@
+# algorithm/UndoJournal.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+from array import array
+
+
+# Stores undo records grouped in steps. Each record is an action, identified by a small integer code, plus its
+# arguments; codes and step boundaries live in compact arrays. Consecutive records of a mergeable action within the
+# same step are folded into one. If max_steps is set, the oldest steps are discarded once the limit is exceeded.
+#
+# Steps loaded from a saved session can be deferred: they are kept in their serialized form, ahead of any steps added
+# since, and only decoded when something needs to look at them.
+class UndoJournal():
+    max_steps = None
+    dropped_steps = 0
+
+    _action_names = None
+    _action_codes = None
+    _mergers = None
+
+    _codes = None
+    _args = None
+    _step_starts = None
+
+    _deferred_steps = None
+    _decode_step = None
+
+    def __init__(self, action_names, mergers=None, max_steps=None):
+        self.max_steps = max_steps
+
+        self._action_names = list(action_names)
+        self._action_codes = dict((name, code) for code, name in enumerate(self._action_names))
+        self._mergers = dict(mergers) if mergers is not None else dict()
+
+        self.clear()
+
+    def clear(self):
+        self._codes = array('B')
+        self._args = []
+        self._step_starts = array('L')
+        self.dropped_steps = 0
+
+        self._deferred_steps = []
+        self._decode_step = None
+
+    # Puts serialized steps before the current ones. decode_step() turns one of them into a list of (action name,
+    # args) records when it is eventually needed.
+    def defer_steps(self, serialized_steps, decode_step):
+        self._decode_deferred_steps()
+
+        self._deferred_steps = list(serialized_steps)
+        self._decode_step = decode_step
+
+        if self.max_steps is not None and len(self) > self.max_steps:
+            self._drop_oldest_steps(len(self) - self.max_steps)
+
+    def knows_action(self, name):
+        return name in self._action_codes
+
+    def new_step(self):
+        self._step_starts.append(len(self._codes))
+
+        if self.max_steps is not None and len(self) > self.max_steps:
+            self._drop_oldest_steps(len(self) - self.max_steps)
+
+    def add(self, action_name, args):
+        if len(self._step_starts) == 0:
+            return
+
+        code = self._action_codes[action_name]
+
+        if len(self._codes) > self._step_starts[-1] and self._codes[-1] == code and action_name in self._mergers:
+            self._args[-1] = self._mergers[action_name](self._args[-1], args)
+            return
+
+        self._codes.append(code)
+        self._args.append(args)
+
+    # Once the steps added since loading are used up, deferred steps are decoded one at a time as they are popped
+    def pop_step(self):
+        if len(self._step_starts) == 0:
+            records = self._decode_records(self._deferred_steps.pop())
+            if len(self._deferred_steps) == 0:
+                self._decode_step = None
+
+            return records
+
+        start = self._step_starts.pop()
+
+        records = [(self._action_names[code], args) for code, args in zip(self._codes[start:], self._args[start:])]
+
+        del self._codes[start:]
+        del self._args[start:]
+
+        return records
+
+    # Discards records so that the journal ends right after the given step, counting dropped steps too. If that step
+    # is not covered by the journal, everything is discarded and the journal restarts from there.
+    def truncate(self, step):
+        keep = step - self.dropped_steps
+
+        if keep < 0 or keep > len(self):
+            self.clear()
+            self.dropped_steps = step
+            return
+
+        if keep <= len(self._deferred_steps):
+            del self._deferred_steps[keep:]
+            del self._codes[:]
+            del self._args[:]
+            del self._step_starts[:]
+            return
+
+        keep -= len(self._deferred_steps)
+
+        if keep < len(self._step_starts):
+            cut = self._step_starts[keep]
+
+            del self._codes[cut:]
+            del self._args[cut:]
+            del self._step_starts[keep:]
+
+    def steps(self):
+        self._decode_deferred_steps()
+
+        bounds = list(self._step_starts) + [len(self._codes)]
+
+        return [[(self._action_names[self._codes[index]], self._args[index]) for index in xrange(start, end)]
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def set_max_steps(self, max_steps):
+        self.max_steps = max_steps
+
+        if max_steps is not None and len(self) > max_steps:
+            self._drop_oldest_steps(len(self) - max_steps)
+
+    def __len__(self):
+        return len(self._deferred_steps) + len(self._step_starts)
+
+    def _decode_deferred_steps(self):
+        if len(self._deferred_steps) == 0:
+            return
+
+        codes, args, step_starts = self._codes, self._args, self._step_starts
+        self._codes = array('B')
+        self._args = []
+        self._step_starts = array('L')
+
+        for serialized_step in self._deferred_steps:
+            self._step_starts.append(len(self._codes))
+
+            for action_name, action_args in self._decode_records(serialized_step):
+                self.add(action_name, action_args)
+
+        offset = len(self._codes)
+        self._codes.extend(codes)
+        self._args.extend(args)
+        self._step_starts.extend(start + offset for start in step_starts)
+
+        self._deferred_steps = []
+        self._decode_step = None
+
+    def _decode_records(self, serialized_step):
+        records = self._decode_step(serialized_step)
+
+        for action_name, _ in records:
+            if not self.knows_action(action_name):
+                raise RuntimeError("No such action: '{0}'".format(action_name))
+
+        return records
+
+    def _drop_oldest_steps(self, count):
+        deferred_count = min(count, len(self._deferred_steps))
+        del self._deferred_steps[:deferred_count]
+        self.dropped_steps += deferred_count
+        count -= deferred_count
+
+        if count == 0:
+            return
+
+        cut = self._step_starts[count] if count < len(self._step_starts) else len(self._codes)
+
+        del self._codes[:cut]
+        del self._args[:cut]
+        self._step_starts = array('L', (start - cut for start in self._step_starts[count:]))
+
+        self.dropped_steps += count
@@ -9,40 +9,137 @@
 # Licensed under the GPL-3
 
 import json
+import os
 
 from structures.Session import Session
+from structures.BinarySessionFormat import BinarySessionFormat, COMPRESSION_ZLIB, COMPRESSION_LZMA
+from structures.SessionJournal import SessionJournal
+from algorithm.Setup import Setup
+from algorithm.DerivationSearch import DerivationSearch
+
+
+# Sessions saved under these extensions use the binary format, with the given compression
+BINARY_SESSION_EXTENSIONS = {
+    '.spz': COMPRESSION_ZLIB,
+    '.spx': COMPRESSION_LZMA,
+}
+
+# Sessions saved under this extension are kept as an append-only journal of actions
+JOURNAL_SESSION_EXTENSION = '.spj'
+
+# Saving to the journal a session is kept in compacts it once it holds more than this many action records
+JOURNAL_COMPACTION_THRESHOLD = 1000
+
+# How many steps of a session can be undone by default, so that the undo history of long sessions stops growing
+DEFAULT_UNDO_LIMIT = 10000
 
 
 class SpelloutApp():
     session = None
 
+    _journal = None
+    _journaled_setup = None
+    _undo_limit = DEFAULT_UNDO_LIMIT
+    # The search behind the last next_possibility(True), as (setup, choices of the derivation found, derivations left)
+    _successful_search = None
+
     def __init__(self):
         self.session = Session()
+        self.session.algorithm.set_undo_limit(self._undo_limit)
+
+    # The format is recognized from the file contents, whatever the extension. Actions taken after loading a journal
+    # are only appended to it if keep_journal is set; otherwise the file is left as it is until saved to explicitly.
+    def load_session(self, filename, keep_journal=False):
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        self._close_journal()
 
-    def load_session(self, filename):
-        with open(filename, "r") as f:
-            obj = json.load(f)
+        if SessionJournal.is_journal(data):
+            obj, records, valid_length = SessionJournal.parse(data)
+        else:
+            obj = BinarySessionFormat.loads(data) if BinarySessionFormat.is_binary_session(data) else json.loads(data)
+            records = None
 
         self.session = Session.from_json_obj(obj)
         self.session.filename = filename
 
+        if records is not None:
+            for record in records:
+                try:
+                    self._replay_record(record)
+                except (KeyError, TypeError, AttributeError) as e:
+                    raise RuntimeError(u"Malformed session journal record ({0}: {1})".format(e.__class__.__name__, e))
+
+            if keep_journal:
+                self._attach_journal(SessionJournal(filename, valid_length, len(records)))
+
+        # Only applied after replaying the journal, which may refer to steps recorded under a more generous limit
+        self.session.algorithm.set_undo_limit(self._undo_limit)
+
+    # Saving to a journal the session is already kept in costs next to nothing, as all actions were appended as they
+    # happened; only the setup is recorded, if it was edited since. Once the journal has grown long, it is compacted
+    # instead, so that loading it does not have to replay ever more records. Otherwise the whole session is written
+    # out.
     def save_session(self, filename=None):
         if filename is None:
             if self.session.filename is None:
                 raise RuntimeError("No filename specified for saving session")
             filename = self.session.filename
 
-        with open(filename, "wt+") as f:
-            json.dump(self.session.to_json_obj(), f, indent=4)
+        _, extension = os.path.splitext(filename)
+        compression = BINARY_SESSION_EXTENSIONS.get(extension.lower())
+
+        if extension.lower() == JOURNAL_SESSION_EXTENSION:
+            if self._journal is not None and self._journal.filename == filename:
+                self._record_setup_if_changed()
+                if self._journal.record_count > JOURNAL_COMPACTION_THRESHOLD:
+                    self.compact_journal()
+                else:
+                    self._journal.flush()
+            else:
+                self._close_journal()
+                self._attach_journal(SessionJournal.create(filename, self.session.to_json_obj()))
+        elif compression is not None:
+            data = BinarySessionFormat.dumps(self.session.to_json_obj(), compression)
+            with open(filename, "wb") as f:
+                f.write(data)
+        else:
+            with open(filename, "wt+") as f:
+                json.dump(self.session.to_json_obj(), f, indent=4)
+
+        if extension.lower() != JOURNAL_SESSION_EXTENSION:
+            self._close_journal()
 
         self.session.filename = filename
 
+    def undo_limit(self):
+        return self._undo_limit
+
+    # Applies to the current session and to any loaded later. None means no limit.
+    def set_undo_limit(self, max_steps):
+        self._undo_limit = max_steps
+        self.session.algorithm.set_undo_limit(max_steps)
+
+    def has_journal(self):
+        return self._journal is not None
+
+    # Rewrites the journal the session is kept in as just the current session, dropping the action records
+    def compact_journal(self):
+        if self._journal is None:
+            raise RuntimeError("The session is not kept in a journal")
+
+        filename = self._journal.filename
+        self._close_journal()
+        self._attach_journal(SessionJournal.create(filename, self.session.to_json_obj()))
+
     def can_go_forward(self):
         return (not self.session.algorithm.started()) or self.session.algorithm.can_go_forward()
 
     def go_forward(self, alternative=None):
         if self.session.algorithm.started():
             self.session.algorithm.go_forward(alternative)
+            self._record('forward', alternative=alternative)
         else:
             self.restart_algorithm()
 
@@ -51,34 +148,69 @@ class SpelloutApp():
 
     def go_back(self):
         self.session.algorithm.go_back()
+        self._record('back')
+
+    def current_step(self):
+        return self.session.algorithm.current_step()
+
+    def step_count(self):
+        return self.session.algorithm.step_count()
+
+    def go_to_step(self, step):
+        offset = step - self.session.algorithm.current_step()
+
+        self.session.algorithm.go_to_step(step)
+        self._record('jump', offset=offset)
 
     def can_go_to_end(self):
         return self.can_go_forward()
 
-    def go_to_end(self):
-        while self.can_go_forward():
-            self.go_forward(None)
+    def go_to_end(self, quiet=False):
+        if not quiet:
+            while self.can_go_forward():
+                self.go_forward(None)
+            return
 
+        if not self.session.algorithm.started():
+            self.restart_algorithm()
+
+        self.session.algorithm.set_quiet(True)
+        try:
+            while self.session.algorithm.can_go_forward():
+                self.session.algorithm.go_forward(None)
+        finally:
+            self.session.algorithm.set_quiet(False)
+
+        self._record('quiet_run')
+
+    # With only_successful, the first successful derivation is found by a quiet search, and only then run with
+    # logging. If there is none, the first derivation is run as usual.
     def do_full_run(self, only_successful=False):
         self.restart_algorithm()
-        self.go_to_end()
 
-        if only_successful and not self.session.algorithm.success():
-            success = self.next_possibility(True)
-            if not success:
-                self.go_to_end()
+        derivation = next(self.all_derivations(True), None) if only_successful else None
+        if derivation is None:
+            self.go_to_end()
+            return not only_successful
 
-            return success
+        self._run_choices(derivation.choices)
 
         return True
 
     def has_next_possibility(self):
-        return self.session.algorithm.last_choice() is not None
+        return self.has_last_choice()
 
+    # With an undo limit, the last choice may have been made at a step that can no longer be reached. Its alternative
+    # is still remembered for choice_vector().
     def has_last_choice(self):
-        return self.session.algorithm.last_choice() is not None
+        choice_steps = self.session.algorithm.choice_steps()
+
+        return len(choice_steps) > 0 and self.session.algorithm.can_reach_step(choice_steps[-1])
 
     def next_possibility(self, only_successful=False):
+        if only_successful:
+            return self._next_successful_possibility()
+
         while True:
             last_choice = self.session.algorithm.last_choice()
             if not self.go_to_last_choice():
@@ -91,20 +223,139 @@ class SpelloutApp():
             self.go_forward(last_choice + 1)
             self.go_to_end()
 
-            if only_successful and not self.session.algorithm.success():
+            return True
+
+    # The next successful derivation is found by a quiet search of the derivations after the current one, and only
+    # run with logging from the choice where it departs from the current run. If the current run is still the one
+    # found last time, the same search simply carries on.
+    def _next_successful_possibility(self):
+        if not self.has_last_choice():
+            return False
+
+        setup = self.session.algorithm.setup()
+        current = list(self.choice_vector())
+
+        last_search = self._successful_search
+        if last_search is not None and last_search[0] is setup and last_search[1] == current:
+            derivations = last_search[2]
+        else:
+            derivations = DerivationSearch(setup).derivations_after(current)
+
+        derivation = next((derivation for derivation in derivations if derivation.success), None)
+        if derivation is None:
+            self._successful_search = None
+            return False
+
+        choices = list(derivation.choices)
+
+        fork = next(index for index, (choice, current_choice) in enumerate(zip(choices, current))
+                    if choice != current_choice)
+        fork_step = self.session.algorithm.choice_steps()[fork]
+        if not self.session.algorithm.can_reach_step(fork_step):
+            return False
+
+        self.go_to_step(fork_step)
+        self._run_choices(choices[fork:])
+        self._successful_search = (setup, choices, derivations)
+
+        return True
+
+    def all_derivations(self, only_successful=False, parallel=False, processes=None):
+        search = DerivationSearch(self.session.setup)
+        derivations = search.parallel_derivations(processes) if parallel else search.derivations()
+
+        for derivation in derivations:
+            if only_successful and not derivation.success:
                 continue
 
-            return True
+            yield derivation
+
+    def best_derivations(self, k=None):
+        return DerivationSearch(self.session.setup).best_derivations(k)
+
+    def choice_vector(self):
+        return self.session.algorithm.choice_vector()
+
+    # Replaces the current run with the final state of the given derivation, skipping the intermediate steps
+    def go_to_derivation(self, choices):
+        algorithm = DerivationSearch(self.session.setup).replay_to_end(choices)
+        algorithm.set_quiet(False)
+        algorithm.set_undo_limit(self._undo_limit)
+
+        self.session.algorithm = algorithm
+        self._record_setup_if_changed()
+        self._record('derivation', choices=list(choices))
 
     def go_to_last_choice(self):
         if not self.has_last_choice():
             return False
 
-        self.go_back()
-        while not self.session.algorithm.in_choice_state():
-            self.go_back()
+        self.go_to_step(self.session.algorithm.choice_steps()[-1])
 
         return True
 
     def restart_algorithm(self):
         self.session.algorithm.start(self.session.setup)
+        self._record_setup_if_changed()
+        self._record('restart')
+
+    # Goes to the end, taking the given alternatives at the choice points on the way
+    def _run_choices(self, choices):
+        choices = iter(choices)
+
+        while self.can_go_forward():
+            self.go_forward(next(choices) if self.session.algorithm.in_choice_state() else None)
+
+    def _record(self, action, **args):
+        if self._journal is None:
+            return
+
+        try:
+            self._journal.append(action, **args)
+        except IOError:
+            # E.g. a read-only journal. The session carries on like one loaded from any other file.
+            self._close_journal()
+
+    # The setup can be edited freely between actions, so it is compared with the last one recorded rather than
+    # tracked
+    def _record_setup_if_changed(self):
+        if self._journal is None:
+            return
+
+        setup_obj = self.session.setup.to_json_obj()
+        if setup_obj != self._journaled_setup:
+            self._record('setup', setup=setup_obj)
+            self._journaled_setup = setup_obj
+
+    def _replay_record(self, record):
+        action = record.get('action')
+
+        if action == 'forward':
+            self.go_forward(record['alternative'])
+        elif action == 'back':
+            self.go_back()
+        elif action == 'jump':
+            self.go_to_step(self.session.algorithm.current_step() + record['offset'])
+        elif action == 'quiet_run':
+            self.go_to_end(quiet=True)
+        elif action == 'derivation':
+            self.go_to_derivation(record['choices'])
+        elif action == 'setup':
+            self.session.setup = Setup.from_json_obj(record['setup'])
+        elif action == 'restart':
+            # Earlier journals stored the setup with every restart
+            if 'setup' in record:
+                self.session.setup = Setup.from_json_obj(record['setup'])
+            self.restart_algorithm()
+        else:
+            raise RuntimeError("Unknown action in session journal: '{0}'".format(action))
+
+    def _attach_journal(self, journal):
+        self._journal = journal
+        self._journaled_setup = self.session.setup.to_json_obj()
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            self._journaled_setup = None
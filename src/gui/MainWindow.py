@@ -13,11 +13,20 @@ from PyQt4.QtGui import QMainWindow, QFileDialog, QStyle, QListWidgetItem
 from algorithm.Setup import Setup
 from algorithm.SpelloutAlgorithm import MSG_NOTE, MSG_ERROR, MSG_WARNING
 from graphics.AlgorithmTreeRenderer import AlgorithmTreeRenderer
+from structures.BinarySessionFormat import BinarySessionFormat, COMPRESSION_LZMA
 
 from gui.widgets.WindowUtils import WindowUtils
 from gui.templates.Ui_MainWindow import Ui_MainWindow
 
 
+OPEN_SESSION_FILTER = "Sessions [*.json, *.spz, *.spx, *.spj] (*.json *.spz *.spx *.spj);;All files (*)"
+SAVE_SESSION_FILTER = ";;".join(
+    ["Sessions [*.json] (*.json)", "Compressed sessions [*.spz] (*.spz)"] +
+    (["LZMA-compressed sessions [*.spx] (*.spx)"]
+     if BinarySessionFormat.compression_available(COMPRESSION_LZMA) else []) +
+    ["Session journals [*.spj] (*.spj)"])
+
+
 class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
     _gui = None
     _app = None
@@ -106,6 +115,7 @@ class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
         self.go_to_end_action.setEnabled(self._app.can_go_to_end())
         self.next_possibility_button.setEnabled(self._app.has_next_possibility())
         self.next_possibility_action.setEnabled(self._app.has_next_possibility())
+        self.compact_journal_action.setEnabled(self._app.has_journal())
 
     def _update_alternatives(self):
         self.alternatives_combo.clear()
@@ -175,13 +185,12 @@ class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
         self._on_clicked_alternative(value)
 
     def _on_clicked_open(self):
-        filename = unicode(QFileDialog.getOpenFileName(self, "Open Session",
-                                                       filter="Sessions [*.json] (*.json)"))
+        filename = unicode(QFileDialog.getOpenFileName(self, "Open Session", filter=OPEN_SESSION_FILTER))
         if filename == '':
             return
 
         try:
-            self._app.load_session(filename)
+            self._app.load_session(filename, keep_journal=True)
             self._update_all_from_session()
         except Exception as e:
             self._show_error_messagebox(u"Error loading session:\n{0}".format(unicode(e)))
@@ -198,7 +207,7 @@ class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
 
         if save_as or (self._app.session.filename is None):
             filename = unicode(QFileDialog.getSaveFileName(
-                self, "Save Session", self._app.session.name() + ".json", "Sessions [*.json] (*.json)"))
+                self, "Save Session", self._app.session.name() + ".json", SAVE_SESSION_FILTER))
             if filename == '':
                 return
         else:
@@ -207,6 +216,7 @@ class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
         try:
             self._app.save_session(filename)
             self._update_title()
+            self._update_controls()
         except Exception as e:
             import sys
             import traceback
@@ -214,6 +224,14 @@ class MainWindow(QMainWindow, Ui_MainWindow, WindowUtils):
             traceback.print_exc(file=sys.stderr)
             self._show_error_messagebox(u"Error saving session:\n{0}".format(unicode(e)))
 
+    def _on_clicked_compact_journal(self):
+        try:
+            self._app.compact_journal()
+        except Exception as e:
+            self._show_error_messagebox(u"Error compacting session journal:\n{0}".format(unicode(e)))
+
+        self._update_controls()
+
     def _on_toggled_advanced(self, active):
         self.advanced_box.setVisible(active)
 
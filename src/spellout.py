@@ -8,23 +8,106 @@
 #
 # Licensed under the GPL-3
 
+import argparse
+import json
 import sys
 
-from app.SpelloutApp import SpelloutApp
-from gui.Gui import Gui
+from app.SpelloutApp import SpelloutApp, DEFAULT_UNDO_LIMIT
+from algorithm.ChoiceVector import ChoiceVector
+
+
+def spellout_to_json_obj(spellout):
+    return [{'name': item.name, 'phonological_content': item.phonological_content} for item in spellout]
+
+
+# Returns the exit status: non-zero if any session could not be processed
+def run_batch(args):
+    status = 0
+
+    for filename in args.sessions:
+        try:
+            app = SpelloutApp()
+            app.load_session(filename)
+
+            if args.all:
+                for derivation in app.all_derivations(args.only_successful, args.parallel, args.processes):
+                    emit_json_line({'session': filename,
+                                    'id': derivation.choice_vector().to_hex(),
+                                    'choices': list(derivation.choices),
+                                    'success': derivation.success,
+                                    'spellout': spellout_to_json_obj(derivation.spellout)})
+            elif args.only_successful and args.derivation is None:
+                # The first successful derivation, searched for without logging or undo information
+                derivation = next(app.all_derivations(True, args.parallel, args.processes), None)
+                if derivation is not None:
+                    emit_spellout(filename, derivation.success, derivation.spellout)
+            else:
+                if args.derivation is not None:
+                    app.go_to_derivation(ChoiceVector.from_hex(args.derivation))
+                else:
+                    app.restart_algorithm()
+                    app.go_to_end(quiet=True)
+
+                emit_spellout(filename, app.session.algorithm.success(), app.session.algorithm.spellout())
+        except (IOError, ValueError, RuntimeError) as e:
+            sys.stderr.write(u'{0}: {1}\n'.format(filename, unicode(e)))
+            status = 1
+
+    return status
+
+
+def emit_spellout(filename, success, spellout):
+    emit_json_line({'session': filename, 'success': success, 'spellout': spellout_to_json_obj(spellout)})
+
+
+def emit_json_line(obj):
+    sys.stdout.write(json.dumps(obj) + '\n')
+    sys.stdout.flush()
+
+
+def run_gui(args):
+    # Imported here so that batch mode never loads PyQt4
+    from gui.Gui import Gui
+
+    app = SpelloutApp()
+    if args.undo_limit is not None:
+        app.set_undo_limit(args.undo_limit if args.undo_limit > 0 else None)
+    if len(args.sessions) > 0:
+        app.load_session(args.sessions[0], keep_journal=True)
+
+    gui = Gui(app)
+    gui.run_blocking()
 
 
 def main():
-    try:
-        app = SpelloutApp()
-        if len(sys.argv) > 1:
-            app.load_session(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Nanosyntactic spellout algorithm")
+    parser.add_argument('sessions', nargs='*', metavar='SESSION', help="session file(s) to load")
+    parser.add_argument('--batch', action='store_true',
+                        help="run the algorithm on each session without a GUI and print the spellouts as JSON lines")
+    parser.add_argument('--only-successful', action='store_true', help="in batch mode, skip failed derivations")
+    parser.add_argument('--all', action='store_true', help="in batch mode, print every derivation, not just the first")
+    parser.add_argument('--parallel', action='store_true',
+                        help="in batch mode, search for derivations in several processes")
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help="with --parallel, the number of processes to use (default: one per CPU)")
+    parser.add_argument('--undo-limit', type=int, metavar='STEPS',
+                        help="in the GUI, how many steps can be undone (0 for no limit; default: {0})".format(
+                            DEFAULT_UNDO_LIMIT))
+    parser.add_argument('--derivation', metavar='ID',
+                        help="in batch mode, replay the derivation with this ID (as printed by --all) instead")
+    args = parser.parse_args()
 
-        gui = Gui(app)
-        gui.run_blocking()
+    try:
+        if args.batch:
+            return run_batch(args)
+        else:
+            run_gui(args)
     except RuntimeError as e:
         sys.stderr.write(unicode(e) + '\n')
+        return 1
+
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# structures/BinarySessionFormat.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+import json
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+MAGIC = 'SPLOUT'
+VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+
+# Stores the JSON object of a session in compact form: a short header (magic, version, compression method) followed
+# by the object as unindented JSON, optionally compressed with zlib or LZMA. The setup kept by the algorithm is not
+# written again if it is the same as the session's.
+#
+# Repeated strings such as keys, features and action names are left for the compressor to share, which keeps both
+# directions in the C parts of the json and zlib modules.
+class BinarySessionFormat():
+    @staticmethod
+    def compression_available(compression):
+        return compression != COMPRESSION_LZMA or lzma is not None
+
+    @staticmethod
+    def dumps(session_obj, compression=COMPRESSION_ZLIB):
+        if not BinarySessionFormat.compression_available(compression):
+            raise RuntimeError("LZMA compression is not available on this system")
+
+        session_obj = dict(session_obj)
+        algorithm_obj = session_obj.get('algorithm')
+
+        shared_setup = algorithm_obj is not None and algorithm_obj.get('setup') == session_obj.get('setup')
+        if shared_setup:
+            algorithm_obj = dict(algorithm_obj)
+            del algorithm_obj['setup']
+            session_obj['algorithm'] = algorithm_obj
+
+        payload = json.dumps({'session': session_obj, 'shared_setup': shared_setup}, separators=(',', ':'))
+
+        if compression == COMPRESSION_ZLIB:
+            payload = zlib.compress(payload, 6)
+        elif compression == COMPRESSION_LZMA:
+            payload = lzma.compress(payload)
+
+        return MAGIC + chr(VERSION) + chr(compression) + payload
+
+    @staticmethod
+    def loads(data):
+        if not BinarySessionFormat.is_binary_session(data):
+            raise RuntimeError("Not a binary session file")
+
+        version = ord(data[len(MAGIC)])
+        compression = ord(data[len(MAGIC) + 1])
+        payload = data[len(MAGIC) + 2:]
+
+        if version != VERSION:
+            raise RuntimeError("Unsupported binary session version: {0}".format(version))
+
+        try:
+            if compression == COMPRESSION_ZLIB:
+                payload = zlib.decompress(payload)
+            elif compression == COMPRESSION_LZMA:
+                if lzma is None:
+                    raise RuntimeError("This session is LZMA-compressed, but LZMA is not available on this system")
+                payload = lzma.decompress(payload)
+            elif compression != COMPRESSION_NONE:
+                raise RuntimeError("Unsupported compression method: {0}".format(compression))
+        except zlib.error as e:
+            raise RuntimeError("Corrupted session file: {0}".format(e))
+
+        obj = json.loads(payload)
+
+        try:
+            session_obj = obj['session']
+            if obj['shared_setup']:
+                session_obj['algorithm']['setup'] = session_obj['setup']
+        except (KeyError, TypeError) as e:
+            raise RuntimeError(u"Malformed session data ({0}: {1})".format(e.__class__.__name__, e))
+
+        return session_obj
+
+    @staticmethod
+    def is_binary_session(data):
+        return data[:len(MAGIC)] == MAGIC and len(data) >= len(MAGIC) + 2
@@ -39,10 +39,15 @@ class Session:
 
         return obj
 
+    # Data with missing or mistyped fields is reported as a RuntimeError, like any other invalid session
     @staticmethod
     def from_json_obj(data):
         session = Session()
-        session.setup = Setup.from_json_obj(data['setup'])
-        session.algorithm = SpelloutAlgorithm.from_json_obj(data['algorithm'])
+
+        try:
+            session.setup = Setup.from_json_obj(data['setup'])
+            session.algorithm = SpelloutAlgorithm.from_json_obj(data['algorithm'])
+        except (KeyError, IndexError, TypeError, AttributeError) as e:
+            raise RuntimeError(u"Malformed session data ({0}: {1})".format(e.__class__.__name__, e))
 
         return session
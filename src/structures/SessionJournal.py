@@ -0,0 +1,108 @@
+# structures/SessionJournal.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+import json
+import os
+
+
+HEADER_LINE = '{"format":"spellout-journal","version":1}\n'
+
+
+# Append-only session file. The first line identifies the format, the second holds the session as it was when the
+# journal was (re)started, and every line after that is a small JSON record of one action taken since. Records are
+# flushed as soon as they are written, so a crash loses at most the record being written; a partial last line is
+# ignored on loading and cut off before appending again. The file is only opened for writing once there is something
+# to append, so merely viewing a journal (even a read-only one) leaves it untouched.
+class SessionJournal():
+    filename = None
+    record_count = 0
+
+    _valid_length = None
+    _file = None
+
+    def __init__(self, filename, valid_length, record_count=0):
+        self.filename = filename
+        self.record_count = record_count
+        self._valid_length = valid_length
+
+    def append(self, action, **args):
+        args['action'] = action
+
+        if self._file is None:
+            self._file = open(self.filename, "r+b")
+            self._file.truncate(self._valid_length)
+            self._file.seek(self._valid_length)
+
+        self._file.write(json.dumps(args, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.record_count += 1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # Writes a fresh journal holding just the given session and opens it for appending. The file is replaced
+    # atomically, so the old journal stays intact if this fails midway.
+    @staticmethod
+    def create(filename, session_obj):
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, "wb") as f:
+            f.write(HEADER_LINE)
+            f.write(json.dumps(session_obj, separators=(',', ':')) + '\n')
+            length = f.tell()
+
+        try:
+            os.rename(temp_filename, filename)
+        except OSError:
+            # Windows will not rename over an existing file
+            os.remove(filename)
+            os.rename(temp_filename, filename)
+
+        return SessionJournal(filename, length)
+
+    @staticmethod
+    def is_journal(data):
+        return data.startswith(HEADER_LINE)
+
+    # Returns the session object, the list of records and the length of the valid part of the data
+    @staticmethod
+    def parse(data):
+        if not SessionJournal.is_journal(data):
+            raise RuntimeError("Not a session journal")
+
+        lines = data.split('\n')
+        complete_lines = lines[:-1]
+
+        if len(complete_lines) < 2:
+            raise RuntimeError("The session journal is truncated")
+
+        try:
+            session_obj = json.loads(complete_lines[1])
+        except ValueError:
+            raise RuntimeError("The session journal is corrupted")
+
+        records = []
+        valid_length = len(complete_lines[0]) + len(complete_lines[1]) + 2
+
+        for line_no, line in enumerate(complete_lines[2:]):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                if line_no < len(complete_lines) - 3:
+                    raise RuntimeError("The session journal is corrupted at line {0}".format(line_no + 3))
+                break
+
+            valid_length += len(line) + 1
+
+        return session_obj, records, valid_length
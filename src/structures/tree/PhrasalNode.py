@@ -11,13 +11,22 @@ from structures.tree.TreeNode import TreeNode
 
 class PhrasalNode(TreeNode):
     feature = None
-    degree = None
+    _degree = None
     
     def __init__(self, feature, degree, left=None, right=None):
         TreeNode.__init__(self, left, right)
         self.feature = feature
         self.degree = degree
 
+    @property
+    def degree(self):
+        return self._degree
+
+    @degree.setter
+    def degree(self, value):
+        self._degree = value
+        self._invalidate_cached()
+
     def clone(self):
         return PhrasalNode(self.feature, self.degree)._on_cloned_from(self)
 
@@ -0,0 +1,88 @@
+# structures/tree/SignatureInterner.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+
+# Assigns a small integer ID to every distinct signature. A signature is stored as its head feature plus the IDs of
+# its sub-signatures, so two signatures are equal iff their IDs are.
+class SignatureInterner():
+    _ids = None
+    _entries = None
+
+    def __init__(self):
+        self._ids = dict()
+        self._entries = []
+
+    def intern(self, head, sub_ids):
+        if head is None:
+            return None
+
+        parts = []
+        for sub_id in sub_ids:
+            if sub_id is None:
+                continue
+
+            sub_head, sub_parts = self._entries[sub_id]
+            if sub_head == head:
+                parts.extend(sub_parts)
+            else:
+                parts.append(sub_id)
+
+        key = (head, tuple(parts))
+
+        sig_id = self._ids.get(key)
+        if sig_id is None:
+            sig_id = len(self._entries)
+            self._ids[key] = sig_id
+            self._entries.append(key)
+
+        return sig_id
+
+    def key(self, sig_id):
+        return self._entries[sig_id] if sig_id is not None else None
+
+    # Works out the key intern() would store a signature under, without adding it. Sub-signatures are given as keys
+    # too, so that probes can be chained up a tree. Returns None if no known signature can be or contain this one,
+    # i.e. if one of its parts is unknown.
+    def probe(self, head, sub_keys):
+        if head is None:
+            return None
+
+        parts = []
+        for sub_key in sub_keys:
+            if sub_key is None:
+                continue
+
+            sub_head, sub_parts = sub_key
+            if sub_head == head:
+                parts.extend(sub_parts)
+                continue
+
+            sub_id = self._ids.get(sub_key)
+            if sub_id is None:
+                return None
+
+            parts.append(sub_id)
+
+        return head, tuple(parts)
+
+    def lookup(self, key):
+        return self._ids.get(key)
+
+    def signature(self, sig_id):
+        if sig_id is None:
+            return None
+
+        head, parts = self._entries[sig_id]
+
+        return (head,) + tuple(self.signature(part) for part in parts)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+signature_interner = SignatureInterner()
@@ -10,11 +10,27 @@ from structures.tree.TreeNode import TreeNode
 
 
 class TraceNode(TreeNode):
-    of_node = None
+    _of_node = None
     
     def __init__(self, of_node):
         TreeNode.__init__(self, None, None)
         self.of_node = of_node
+
+    @property
+    def of_node(self):
+        return self._of_node
+
+    @of_node.setter
+    def of_node(self, value):
+        if self._of_node is not None:
+            self._of_node._remove_dependent(self)
+
+        self._of_node = value
+
+        if value is not None:
+            value._add_dependent(self)
+
+        self._invalidate_cached()
     
     def subtree_size(self):
         return 0
@@ -28,6 +44,9 @@ class TraceNode(TreeNode):
     def name(self):
         return "t{0}".format(self.of_node.name())
     
+    def _fill_snapshot(self, snapshot):
+        snapshot.of_node = self.of_node.snapshot() if self.of_node is not None else None
+
     def _fill_json_obj(self, obj, nodes_to_ids):
         if nodes_to_ids is None:
             raise RuntimeError("Cannot JSON-ize TraceNode without nodes_to_ids map")
@@ -11,17 +11,18 @@ from structures.tree.PhrasalNode import PhrasalNode
 from structures.tree.TraceNode import TraceNode
 from structures.tree.PlaceholderNode import PlaceholderNode
 
-from collections import deque
-
 
 class Tree:
     root = None
 
+    _snapshot_parents = None
+
     def __init__(self, root_node):
         self.root = root_node
 
-    def clone(self):
-        mapping = {}
+    def clone(self, mapping=None):
+        if mapping is None:
+            mapping = {}
 
         for node in self.root.bfs():
             mapping[node] = node.clone()
@@ -39,8 +40,24 @@ class Tree:
     def bfs(self):
         return self.root.bfs()
 
+    # Relies on the parent links kept by TreeNode.set_child(), so the node is assumed to belong to this tree. Snapshot
+    # nodes have no parent links, but they never change either, so their parents are mapped once per tree.
     def locate_node(self, node):
-        return self.root.locate_child(node)
+        if node == self.root:
+            return None, 0
+
+        if node.is_snapshot():
+            if self._snapshot_parents is None:
+                self._snapshot_parents = dict(((child, (parent, side)) for parent in self.root.bfs()
+                                               for side, child in ((0, parent.left), (1, parent.right))
+                                               if child is not None))
+
+            return self._snapshot_parents.get(node, (None, None))
+
+        if node.parent() is None:
+            return None, None
+
+        return node.parent(), node.side_in_parent()
 
     def check(self):
         for node in self.root.bfs():
@@ -51,42 +68,76 @@ class Tree:
             if isinstance(node, PlaceholderNode):
                 raise RuntimeError("Some nodes are still not filled in")
 
-    def to_json_obj(self):
-        nodes_to_ids = dict(((node, i + 1) for i, node in enumerate(self.root.bfs())))
+    # Flat form: the nodes are listed in BFS order and refer to their children (and traces to their antecedents) by
+    # 1-based position in the list, the same IDs used for @node: references elsewhere. A map of nodes to these IDs
+    # may be passed in if the caller already has one.
+    def to_json_obj(self, nodes_to_ids=None):
+        if nodes_to_ids is None:
+            nodes_to_ids = dict(((node, i + 1) for i, node in enumerate(self.root.bfs())))
 
-        obj = {
-            'root': self.root.to_json_obj(nodes_to_ids)
-        }
+        node_objs = []
+        for node in self.root.bfs():
+            obj = node._own_json_obj(nodes_to_ids)
 
-        return obj
+            if node.left is not None:
+                obj['left'] = nodes_to_ids[node.left]
+            if node.right is not None:
+                obj['right'] = nodes_to_ids[node.right]
 
-    @staticmethod
-    def from_json_obj(obj):
-        def bfs_json_tree(root):
-            q = deque()
-            q.appendleft(root)
+            node_objs.append(obj)
 
-            while len(q) > 0:
-                head = q.popleft()
-                yield head
-
-                for key in ('left', 'right'):
-                    if (key in head) and (head[key] is not None):
-                        q.append(head[key])
+        return {'nodes': node_objs}
 
+    # Reads both the flat form and the older nested one ({'root': ...}). If a list is given for nodes, the nodes of
+    # the tree are appended to it in BFS order.
+    @staticmethod
+    def from_json_obj(obj, nodes=None):
         if obj is None:
             return None
 
-        root = TreeNode.from_json_obj(obj['root'])
+        if 'nodes' in obj:
+            tree_nodes = Tree._nodes_from_flat_json_obj(obj['nodes'])
+        else:
+            tree_nodes = Tree._nodes_from_nested_json_obj(obj['root'])
 
-        ids_to_nodes = dict()
-        for node, json_node in zip(root.bfs(), bfs_json_tree(obj['root'])):
-            if 'id' in json_node:
-                ids_to_nodes[json_node['id']] = node
+        if nodes is not None:
+            nodes.extend(tree_nodes)
+
+        return Tree(tree_nodes[0])
+
+    @staticmethod
+    def _nodes_from_flat_json_obj(node_objs):
+        if len(node_objs) == 0:
+            raise RuntimeError("A tree must have at least one node")
+
+        nodes = [TreeNode._own_from_json_obj(node_obj) for node_obj in node_objs]
+        # IDs are 1-based positions in the list
+        ids_to_nodes = [None] + nodes
+
+        try:
+            for node, node_obj in zip(nodes, node_objs):
+                if 'left' in node_obj:
+                    node.left = ids_to_nodes[node_obj['left']]
+                if 'right' in node_obj:
+                    node.right = ids_to_nodes[node_obj['right']]
+
+                node._finalize_from_json_obj(node_obj, ids_to_nodes)
+        except IndexError:
+            raise RuntimeError("Invalid node ID in tree")
+
+        return nodes
+
+    @staticmethod
+    def _nodes_from_nested_json_obj(root_obj):
+        loaded = []
+        TreeNode.from_json_obj(root_obj, loaded)
 
-        for node, json_node in zip(root.bfs(), bfs_json_tree(obj['root'])):
-            node._finalize_from_json_obj(json_node, ids_to_nodes)
+        ids_to_nodes = dict((node_obj['id'], node) for node, node_obj in loaded if 'id' in node_obj)
 
-        tree = Tree(root)
+        try:
+            for node, node_obj in loaded:
+                node._finalize_from_json_obj(node_obj, ids_to_nodes)
+        except KeyError:
+            raise RuntimeError("Invalid node ID in tree")
 
-        return tree
+        return [node for node, _ in loaded]
@@ -9,27 +9,71 @@
 from collections import deque
 
 import re
+import weakref
 
+from structures.tree.SignatureInterner import signature_interner
 
-class TreeNode:
-    left = None
-    right = None
+
+class TreeNode(object):
+    _left = None
+    _right = None
+    _parent = None
+
+    _signature_id = None
+    _signature_valid = False
+    _subtree_size = None
+    _snapshot = None
+    _dependents = None
 
     def __init__(self, left=None, right=None):
         self.left = left
         self.right = right
-    
+
+    @property
+    def left(self):
+        return self._left
+
+    @left.setter
+    def left(self, value):
+        self.set_child(0, value)
+
+    @property
+    def right(self):
+        return self._right
+
+    @right.setter
+    def right(self, value):
+        self.set_child(1, value)
+
     def children(self):
         return [child for child in (self.left, self.right) if child is not None]
     
     def get_child(self, side):
         return self.left if side == 0 else self.right
+
+    def parent(self):
+        return self._parent
+
+    def side_in_parent(self):
+        if self._parent is None:
+            return None
+
+        return 0 if self._parent.left is self else 1
     
     def set_child(self, side, value):
+        prev_value = self.get_child(side)
+        if prev_value is not None and prev_value._parent is self:
+            prev_value._parent = None
+
         if side == 0:
-            self.left = value
+            self._left = value
         else:
-            self.right = value
+            self._right = value
+
+        if value is not None:
+            value._parent = self
+
+        self._invalidate_cached()
     
     def bfs(self):
         q = deque()
@@ -45,35 +89,81 @@ class TreeNode:
     def locate_child(self, node):
         if node == self:
             return None, 0
-            
-        for parent in self.bfs():
-            if parent.left == node:
-                return parent, 0
-            elif parent.right == node:
-                return parent, 1
-        
-        return None, None
+
+        if node.is_snapshot():
+            for parent in self.bfs():
+                for side in (0, 1):
+                    if parent.get_child(side) is node:
+                        return parent, side
+
+            return None, None
+
+        ancestor = node.parent()
+        while ancestor is not None and ancestor is not self:
+            ancestor = ancestor.parent()
+
+        if ancestor is None:
+            return None, None
+
+        return node.parent(), node.side_in_parent()
 
     def signature(self):
-        my_sig = self.own_signature()
-        if my_sig is None:
-            return
-        
-        sig = [my_sig]
-        
-        for sub_node in (self.left, self.right):
-            if sub_node is not None:
-                sub_sig = sub_node.signature()
-                if sub_sig is not None:
-                    if sub_sig[0] == my_sig:
-                        sig.extend(sub_sig[1:])
-                    else:
-                        sig.append(sub_sig)
-        
-        return tuple(sig)
+        return signature_interner.signature(self.signature_id())
+
+    def signature_id(self):
+        if not self._signature_valid:
+            self._signature_id = signature_interner.intern(
+                self.own_signature(),
+                [sub_node.signature_id() for sub_node in (self.left, self.right) if sub_node is not None]
+            )
+            self._signature_valid = True
+
+        return self._signature_id
+
+    # Returns (parent, side, sig_id) for the edges in the subtree, in BFS order, sig_id being the signature ID this
+    # node would have if the child on that edge were detached. Edges for which that signature is not known are left
+    # out, as nothing (e.g. in the lexicon) can match it.
+    def signatures_without_one_subtree(self):
+        result = []
+
+        for parent in self.bfs():
+            for side in (0, 1):
+                if parent.get_child(side) is None:
+                    continue
+
+                sig_id = self._signature_without_child(parent, side)
+                if sig_id is not None:
+                    result.append((parent, side, sig_id))
+
+        return result
+
+    # Only the path up from the edge is worked out, the other subtrees' signatures come from the cache. Nothing is
+    # interned, and the walk stops as soon as the signature along the path can no longer be part of a known one.
+    def _signature_without_child(self, parent, side):
+        sub_keys = [signature_interner.key(child.signature_id()) if child is not None else None
+                    for child in (parent.left, parent.right)]
+        sub_keys[side] = None
+
+        key = signature_interner.probe(parent.own_signature(), sub_keys)
+        node = parent
+
+        while key is not None and node is not self:
+            node_side = node.side_in_parent()
+            node = node.parent()
+
+            sub_keys = [signature_interner.key(child.signature_id()) if child is not None else None
+                        for child in (node.left, node.right)]
+            sub_keys[node_side] = key
+
+            key = signature_interner.probe(node.own_signature(), sub_keys)
+
+        return signature_interner.lookup(key) if key is not None else None
     
     def subtree_size(self):
-        return 1 + sum((child.subtree_size() for child in self.children()))
+        if self._subtree_size is None:
+            self._subtree_size = 1 + sum((child.subtree_size() for child in self.children()))
+
+        return self._subtree_size
     
     def own_signature(self):
         raise RuntimeError("own_signature() must be overridden in descendants of TreeNode")
@@ -83,24 +173,110 @@ class TreeNode:
     
     def clone(self):
         raise RuntimeError("clone() must be overridden in descendants of TreeNode")
+
+    # Returns an immutable copy of the subtree. Copies are cached and only remade along the paths that changed since
+    # the last call, so unchanged subtrees are shared between successive snapshots. For the same reason, snapshot
+    # nodes have no parent links; Tree.locate_node() works them out instead.
+    def snapshot(self):
+        pending = [self]
+
+        while len(pending) > 0:
+            node = pending[-1]
+
+            missing = [child for child in node.children() if child._snapshot is None]
+            if len(missing) > 0:
+                pending.extend(missing)
+                continue
+
+            pending.pop()
+            if node._snapshot is None:
+                snapshot = node.clone()
+                node._fill_snapshot(snapshot)
+                snapshot._snapshot = snapshot
+                node._snapshot = snapshot
+
+        return self._snapshot
+
+    def is_snapshot(self):
+        return self._snapshot is self
     
+    # Nested form, as used in setups. Built breadth-first rather than recursively, so deep trees are fine.
     def to_json_obj(self, nodes_to_ids=None):
+        root_obj = None
+
+        pending = deque()
+        pending.append((self, None, None))
+
+        while len(pending) > 0:
+            node, parent_obj, key = pending.popleft()
+
+            obj = node._own_json_obj(nodes_to_ids)
+            if nodes_to_ids is not None and node in nodes_to_ids:
+                obj['id'] = nodes_to_ids[node]
+
+            if parent_obj is None:
+                root_obj = obj
+            else:
+                parent_obj[key] = obj
+
+            if node.left is not None:
+                pending.append((node.left, obj, 'left'))
+            if node.right is not None:
+                pending.append((node.right, obj, 'right'))
+
+        return root_obj
+
+    # The JSON object for this node alone, without its children
+    def _own_json_obj(self, nodes_to_ids):
         obj = dict()
         self._fill_json_obj(obj, nodes_to_ids)
-        
-        if nodes_to_ids is not None and self in nodes_to_ids:
-            obj['id'] = nodes_to_ids[self]
 
-        if self.left is not None:
-            obj['left'] = self.left.to_json_obj(nodes_to_ids)
-        if self.right is not None:
-            obj['right'] = self.right.to_json_obj(nodes_to_ids)
-        
         return obj
     
     def _on_cloned_from(self, _):
         return self
 
+    # Children's snapshots are linked without taking them over as their parent, as they may be shared
+    def _fill_snapshot(self, snapshot):
+        if self._left is not None:
+            snapshot._left = self._left._snapshot
+        if self._right is not None:
+            snapshot._right = self._right._snapshot
+
+    # Nodes outside the subtree whose cached values still depend on this node (e.g. traces referring to it)
+    def _add_dependent(self, node):
+        if self._dependents is None:
+            self._dependents = weakref.WeakSet()
+
+        self._dependents.add(node)
+
+    def _remove_dependent(self, node):
+        if self._dependents is not None:
+            self._dependents.discard(node)
+
+    def _has_cached_values(self):
+        return self._signature_valid or self._subtree_size is not None or self._snapshot is not None
+
+    # Cached values for a node depend on its whole subtree, so they are dropped for all its ancestors (and
+    # dependents) as well. A node with valid caches never has descendants with invalid ones, hence the walk can stop
+    # early.
+    def _invalidate_cached(self):
+        pending = [self]
+
+        while len(pending) > 0:
+            node = pending.pop()
+
+            while node is not None and node._has_cached_values():
+                node._signature_valid = False
+                node._signature_id = None
+                node._subtree_size = None
+                node._snapshot = None
+
+                if node._dependents is not None:
+                    pending.extend(node._dependents)
+
+                node = node._parent
+
     def _fill_json_obj(self, obj, nodes_to_ids):
         raise RuntimeError("_fill_json_obj() must be overridden in descendants of TreeNode")
     
@@ -127,31 +303,46 @@ class TreeNode:
         
         return PhrasalNode(feature, degree, connect_left, connect_right)
 
+    # Reads the nested form. If a list is given for loaded, the (node, JSON object) pairs are appended to it in BFS
+    # order.
     @staticmethod
-    def from_json_obj(obj):
+    def from_json_obj(obj, loaded=None):
+        if obj is None:
+            return None
+
+        root = TreeNode._own_from_json_obj(obj)
+
+        pending = deque()
+        pending.append((root, obj))
+
+        while len(pending) > 0:
+            node, node_obj = pending.popleft()
+            if loaded is not None:
+                loaded.append((node, node_obj))
+
+            for side, key in ((0, 'left'), (1, 'right')):
+                if node_obj.get(key) is not None:
+                    child = TreeNode._own_from_json_obj(node_obj[key])
+                    node.set_child(side, child)
+                    pending.append((child, node_obj[key]))
+
+        return root
+
+    # Makes a childless node from its JSON object, ignoring any child entries
+    @staticmethod
+    def _own_from_json_obj(obj):
         from structures.tree.FeatureNode import FeatureNode
         from structures.tree.PhrasalNode import PhrasalNode
         from structures.tree.TraceNode import TraceNode
         from structures.tree.PlaceholderNode import PlaceholderNode
 
-        if obj is None:
-            return None
-        
         if obj['type'] == 'FeatureNode':
-            node = FeatureNode._from_json_obj(obj)
+            return FeatureNode._from_json_obj(obj)
         elif obj['type'] == 'PhrasalNode':
-            node = PhrasalNode._from_json_obj(obj)
+            return PhrasalNode._from_json_obj(obj)
         elif obj['type'] == 'TraceNode':
-            node = TraceNode._from_json_obj(obj)
+            return TraceNode._from_json_obj(obj)
         elif obj['type'] == 'PlaceholderNode':
-            node = PlaceholderNode._from_json_obj(obj)
+            return PlaceholderNode._from_json_obj(obj)
         else:
             raise RuntimeError("Unsupported node type '{0}'".format(obj['type']))
-
-        node.left = node.right = None
-        if 'left' in obj:
-            node.left = TreeNode.from_json_obj(obj['left'])
-        if 'right' in obj:
-            node.right = TreeNode.from_json_obj(obj['right'])
-        
-        return node
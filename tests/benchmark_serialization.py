@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# tests/benchmark_serialization.py
+#
+# (C) Copyright 2013  Cristian Dinu <goc9000@gmail.com>
+#
+# This file is part of spellout.
+#
+# Licensed under the GPL-3
+
+# Times saving and loading sessions of increasing length. With linear (de)serialization, the time per step should
+# stay roughly constant as the sessions grow.
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from app.SpelloutApp import SpelloutApp
+from algorithm.Setup import Setup
+from structures.LexiconEntry import LexiconEntry
+from structures.tree.FeatureNode import FeatureNode
+from structures.tree.PhrasalNode import PhrasalNode
+from structures.tree.Tree import Tree
+
+
+FEATURES = ['A', 'B', 'C', 'D', 'E', 'F']
+
+
+def make_setup(n_merges):
+    setup = Setup()
+    setup.initial_node = FeatureNode(FEATURES[0])
+    setup.external_merges = [FeatureNode(FEATURES[(index + 1) % len(FEATURES)]) for index in xrange(n_merges)]
+
+    for index, feature in enumerate(FEATURES):
+        setup.lexicon.append(LexiconEntry(feature.lower(), feature.lower(), [], Tree(FeatureNode(feature))))
+
+        prev_feature = FEATURES[index - 1]
+        setup.lexicon.append(LexiconEntry(feature.lower() + prev_feature.lower(), feature.lower(), [],
+                                          Tree(PhrasalNode(feature, 0, FeatureNode(feature),
+                                                           FeatureNode(prev_feature)))))
+
+    return setup
+
+
+def timed(function):
+    start = time.time()
+    function()
+
+    return time.time() - start
+
+
+def main():
+    handle, filename = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+
+    print "{0:>8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>12} {6:>12}".format(
+        'merges', 'steps', 'bytes', 'save (s)', 'load (s)', 'save/step', 'load/step')
+
+    try:
+        for n_merges in [25, 50, 100, 200, 400]:
+            app = SpelloutApp()
+            app.session.setup = make_setup(n_merges)
+            app.restart_algorithm()
+            app.go_to_end()
+
+            steps = app.current_step()
+
+            save_time = timed(lambda: app.save_session(filename))
+            load_time = timed(lambda: SpelloutApp().load_session(filename))
+
+            print "{0:>8} {1:>8} {2:>10} {3:>10.3f} {4:>10.3f} {5:>12.6f} {6:>12.6f}".format(
+                n_merges, steps, os.path.getsize(filename), save_time, load_time,
+                save_time / steps, load_time / steps)
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()